@@ -4,6 +4,8 @@
 from trytond.pool import Pool
 from . import health_services
 from . import health
+from . import ir
+from . import product
 from .wizard import wizard_health_insurance
 
 __all__ = ['register']
@@ -13,10 +15,12 @@ def register():
     Pool.register(
         health_services.HealthService,
         health.Insurance,
+        health.InsuranceReferenceTariff,
         health.Invoice,
         health.Lab,
         health.LabTestType,
         health.TestType,
+        health.TestCritearea,
         health.PayInvoiceStart,
         health.Commission,
         health.ImagingTestRequest,
@@ -24,11 +28,21 @@ def register():
         health.Party,
         health.ImagingTestResult,
         health.InvoiceLine,
+        health.InvoiceTax,
+        health.Reconciliation,
         health.Agent,
+        health.AgentRealisation,
+        health.SalesRollup,
+        ir.Cron,
+        product.Category,
+        product.PriceList,
+        product.PriceListLine,
+        product.ProductListPrice,
         module='z_health_extra', type_='model')
     Pool.register(
         health.PayInvoice,
         wizard_health_insurance.CreateServiceInvoice,
         module='z_health_extra', type_='wizard')
     Pool.register(
+        health.BankTransferReport,
         module='z_health_extra', type_='report')
@@ -41,7 +41,6 @@ class Invoice(metaclass=PoolMeta):
         for invoice in invoices:
             for line in invoice.lines:
                 commissions = line.get_commissions()
-                print("ce qu'il faut davoir -------- ", commissions)
                 if commissions:
                     all_commissions.extend(commissions)
 
@@ -62,10 +61,8 @@ class InvoiceLine(metaclass=PoolMeta):
 
         unit_price = Decimal(0)
         if sale_price_list : 
-            unit_price = sale_price_list.compute(
-                            self.invoice.party,
-                            self.product, self.product.list_price,
-                            self.quantity, self.product.default_uom)
+            unit_price, = sale_price_list.compute_many(self.invoice.party, [
+                    (self.product, self.quantity, self.product.default_uom)])
             
         return unit_price
     
@@ -90,7 +87,6 @@ class InvoiceLine(metaclass=PoolMeta):
             amount = self._get_commission_amount(amount, plan)
             if self.invoice.health_service.z_remise2:
                 amount = self._get_commission_amount(self.invoice.total_amount, plan)
-            print(f"Le Amount des Amounts -- ", amount)
             if amount:
                 amount = round_price(amount)
             if not amount:
@@ -160,4 +160,12 @@ class ExploOrderExists(UserError):
 
 
 class LabOrderExists(UserError):
-    pass
\ No newline at end of file
+    pass
+
+
+class ReferenceTariffError(UserError):
+    pass
+
+
+class ReferenceTariffValidationError(ValidationError):
+    pass
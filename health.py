@@ -23,25 +23,27 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
+import csv
+import functools
+import io
 from decimal import Decimal
 from collections import defaultdict, namedtuple
 from itertools import combinations
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 
 from num2words import num2words
-from sql import Null
-from sql.aggregate import Sum
+from sql import Literal, Null
+from sql.aggregate import Count, Max, Min, Sum
 from sql.conditionals import Coalesce, Case
-from sql.functions import Round
+from sql.functions import Position, Round, Substring
 import time
 from datetime import datetime
 import json
 import requests
 from trytond.i18n import gettext
-from trytond.model import Workflow, ModelView, ModelSQL, fields, \
-    sequence_ordered, Unique, DeactivableMixin, dualmethod
+from trytond.model import Workflow, ModelView, ModelSQL, ModelStorage, \
+    fields, sequence_ordered, Unique, DeactivableMixin, dualmethod
 from trytond.model.exceptions import AccessError
-from trytond.pyson import PYSONEncoder
 from trytond.report import Report
 from trytond.wizard import Wizard, StateView, StateTransition, StateAction, \
     Button
@@ -52,6 +54,7 @@ from trytond.transaction import Transaction
 from trytond.pool import Pool
 from trytond.rpc import RPC
 from trytond.config import config
+from trytond.cache import Cache
 from num2words import num2words
 from trytond.modules.product import round_price
 
@@ -64,12 +67,210 @@ import json
 from trytond.model import fields
 from trytond.pool import PoolMeta
 from trytond.modules.account.tax import TaxableMixin
+from trytond.modules.account_invoice.account import _invoices_to_process
 from trytond.modules.product import price_digits
 from trytond.modules.health.core import get_health_professional
 
 from .exceptions import (
     InvoiceTaxValidationError, ExploOrderExists, LabOrderExists, InvoiceNumberError, InvoiceValidationError,
-    InvoiceLineValidationError, PayInvoiceError, InvoicePaymentTermDateWarning)
+    InvoiceLineValidationError, PayInvoiceError, InvoicePaymentTermDateWarning,
+    ReferenceTariffError, ReferenceTariffValidationError)
+
+
+AMOUNT_CACHE_FIELDS = ['montant_patient', 'total_amount2', 'montant_verse',
+    'remboursement', 'dernier_versement']
+
+# Retenue à la source sur les honoraires des médecins
+WITHHOLDING_RATE = Decimal('0.11')
+
+SynthesisBucket = namedtuple('SynthesisBucket',
+    ['total_amount', 'montant_assurance', 'z_remise2', 'net_a_payer',
+        'difference', 'amount_to_pay', 'total_amount2'])
+SynthesisTotals = namedtuple('SynthesisTotals',
+    ['assurance', 'pdmd', 'credit'])
+
+DoctorCommission = namedtuple('DoctorCommission',
+    ['amount', 'withholding', 'net', 'phones'])
+
+InsuranceSplit = namedtuple('InsuranceSplit',
+    ['invoice', 'line', 'assurance', 'patient'])
+
+
+def _report_cache_key(value):
+    if isinstance(value, ModelStorage):
+        return (value.__name__, value.id)
+    if isinstance(value, (list, tuple)):
+        return tuple(_report_cache_key(v) for v in value)
+    return value
+
+
+def report_cached(func):
+    """Garde le résultat d'une méthode appelée par les modèles de rapport
+    pour le reste de l'impression, par méthode et identifiants des
+    enregistrements passés en argument.
+    Le cache vit dans la transaction du rapport et est vidé dès qu'une
+    écriture a lieu."""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        transaction = Transaction()
+        cache = transaction.get_cache().setdefault(
+            'z_health_extra.report_cached', {})
+        if cache.get(None) != transaction.counter:
+            cache.clear()
+            cache[None] = transaction.counter
+        key = (name, _report_cache_key(args),
+            tuple(sorted((k, _report_cache_key(v))
+                    for k, v in kwargs.items())))
+        try:
+            return cache[key]
+        except TypeError:
+            return func(*args, **kwargs)
+        except KeyError:
+            pass
+        result = cache[key] = func(*args, **kwargs)
+        return result
+    return wrapper
+
+
+@report_cached
+def _prescriptor_names(request_model, numbers):
+    """Nom du prescripteur (demandeur du service) de chaque numéro de
+    demande, gardé pour le reste de l'impression: {numéro: nom}"""
+    pool = Pool()
+    Request = pool.get(request_model)
+    HealthService = pool.get('gnuhealth.health_service')
+    HealthProfessional = pool.get('gnuhealth.healthprofessional')
+    Party = pool.get('party.party')
+    request = Request.__table__()
+    service = HealthService.__table__()
+    professional = HealthProfessional.__table__()
+    party = Party.__table__()
+    cursor = Transaction().connection.cursor()
+
+    names = {}
+    for sub_numbers in grouped_slice(set(numbers)):
+        sub_numbers = list(sub_numbers)
+        where = Literal(False)
+        if any(n is not None for n in sub_numbers):
+            where |= request.request.in_(
+                [n for n in sub_numbers if n is not None])
+        if None in sub_numbers:
+            where |= request.request == Null
+        cursor.execute(*request.join(service,
+                condition=request.service == service.id
+                ).join(professional,
+                condition=service.requestor == professional.id
+                ).join(party,
+                condition=professional.name == party.id
+                ).select(request.request, party.name, party.lastname,
+                where=where, order_by=[request.id]))
+        for number, name, lastname in cursor:
+            names.setdefault(
+                number, " ".join(filter(None, [name, lastname])))
+    return {n: names.get(n, "") for n in numbers}
+
+_products_code = ["PEF4",
+                "PEF10",
+                "PEF6",
+                "PEF7",
+                "PEF9",
+                "PEF8",
+                "PEF18",
+                "PEF12",
+                "PEF5",
+                "PEF2",
+                "PEF11",
+                "PEF26",
+                "PEF13",
+                "PAM18",
+                "PEF16",
+                "PEF23",
+                "PEF22",
+                "PIE20",
+                "PCO15",
+                "PSY01",
+                "PSY02",
+                "PSY03",
+                "PSY04",
+                "PSY05",
+                "PLAC22",
+                "PLAC23",
+                "PLAC21",
+                "ACTES MEDICAUX TECHNIQUES"
+                ]
+
+_psychiatrie = [
+                "ACE",
+                "BDI",
+                "BIG 5",
+                "CDI",
+                "DEP-ADO",
+                "DESSIN DE FAMILLE",
+                "ESP",
+                "FAT",
+                "FI",
+                "H & R",
+                "IPPA",
+                "ISP",
+                "LA",
+                "MBI",
+                "MMSE",
+                "PCL- 5",
+                "RCMAS",
+                "REY",
+                "SCL - 90",
+                "SEI",
+                "STAI Y-A et B",
+                "WLC"
+
+]
+
+_infiltration = ["PAM34",
+                "PAM36",
+                "PAM61",
+                "PAM62",
+                "PAM60",
+                "PAM64",
+                "PAM65",
+                "PAM70",
+                "PAM71",
+                "PAM72",
+                "PAM47",
+                "PIE51"]
+
+_anatomo = ["PLAC1",
+                "PLAC9",
+                "PLAC10",
+                "PLAC14",
+                "PLAC16",
+                "PLAC17",
+                "PLAC23",
+                "ANATOMO-CYTOPATHOLOGIE"]
+
+_ophtalmologie = [
+                "PCO24",
+                "POPH4",
+                "OPHTALMOLOGIE"]
+
+_kinesitherapie = ["KINESITHERAPIE",
+                  "K1",
+                  "K2",
+                  "K3",
+                  "K4",
+                  "K5",]
+
+# Anciennes règles codées en dur, reprises dans commission.agent.realisation
+# à la création de la table
+_LEGACY_AGENTS_REALISATION = [
+    (_products_code, "XXXKNS238KWQ"),
+    (_infiltration, "XXXWWH987DMG"),
+    (_anatomo, "XXXVYP466SBQ"),
+    (_ophtalmologie, "XXXXYP530SIH"),
+    (_kinesitherapie, "XXXSRS840ZWU"),
+    (_psychiatrie, "XXXGHD415FDH"),
+    ]
 
 
 class Lab(metaclass=PoolMeta):
@@ -81,6 +282,7 @@ class Lab(metaclass=PoolMeta):
     microscopie = fields.Text('Microscopie')
 
     @staticmethod
+    @report_cached
     def afficher_unites_compactees(records):
         # Filtrer les unités non vides
         unites_remplies = [record.diagnosis for record in records if record.diagnosis]
@@ -88,43 +290,52 @@ class Lab(metaclass=PoolMeta):
         # Joindre les unités avec des points
         return "\n".join(unites_remplies)
     
-    def get_analytes_summary(self, name):
-        summ = ""
-        for analyte in self.critearea:
-            if analyte.result or analyte.result_text:
+    @classmethod
+    def get_analytes_summary(cls, labs, name):
+        pool = Pool()
+        Critearea = pool.get('gnuhealth.lab.test.critearea')
+
+        lines = {l.id: [] for l in labs}
+        for sub_ids in grouped_slice(lines):
+            for analyte in Critearea.search([
+                        ('gnuhealth_lab_id', 'in', list(sub_ids)),
+                        ['OR',
+                            ('result', '!=', None),
+                            ('result_text', '!=', None),
+                            ],
+                        ]):
+                if not (analyte.result or analyte.result_text):
+                    continue
                 res = ""
-                res_text = ""
-                if analyte.result_text:
-                    res_text = analyte.result_text
                 if analyte.result:
                     if analyte.units:
-                        if analyte.units.name :
-                            res = str(analyte.result) + \
-                                " (" + analyte.units.name + ")  "
-                    else :
-                        res = str(analyte.result) + " "
-                summ = summ + analyte.rec_name + "  " + \
-                    res + res_text + "\n"
-        return summ
+                        if analyte.units.name:
+                            res = "%s (%s)  " % (
+                                analyte.result, analyte.units.name)
+                    else:
+                        res = "%s " % analyte.result
+                lines[analyte.gnuhealth_lab_id.id].append(
+                    analyte.rec_name + "  " + res
+                    + (analyte.result_text or "") + "\n")
+        return {i: "".join(l) for i, l in lines.items()}
 
     @staticmethod
+    @report_cached
     def listes_paillasses(records):
-        
-        liste_paillasse = []
-        for record in records :
-            if record.test.test_type.name :
-                if record.test.test_type.name not in liste_paillasse:
-                    liste_paillasse.append(record.test.test_type.name)
+        return list(dict.fromkeys(
+                record.test.test_type.name for record in records
+                if record.test.test_type and record.test.test_type.name))
 
-        return liste_paillasse
-    
     @staticmethod
     def prescriptor_name(id):
+        Lab = Pool().get('gnuhealth.lab')
+        return Lab.prescriptor_names([id])[id]
 
-        pool = Pool()
-        Result = pool.get('gnuhealth.patient.lab.test')
-        Results = Result.search([('request', '=', id)], limit=1)
-        return Results[0].service.requestor.name.name+" "+Results[0].service.requestor.name.lastname
+    @classmethod
+    def prescriptor_names(cls, request_numbers):
+        "Nom du prescripteur de chaque numéro de demande: {numéro: nom}"
+        return _prescriptor_names(
+            'gnuhealth.patient.lab.test', request_numbers)
     
 
 class Insurance(metaclass=PoolMeta):
@@ -147,6 +358,83 @@ class Insurance(metaclass=PoolMeta):
     z_couverture = fields.Numeric("Couverture", digits=(3, 2), help="La couverture",
                                   required=True)
 
+class InsuranceReferenceTariff(ModelSQL, ModelView):
+    'Insurance Reference Tariff'
+    __name__ = 'gnuhealth.insurance.reference_tariff'
+
+    insurer = fields.Many2One('party.party', 'Assureur',
+        domain=[('is_insurance_company', '=', True)],
+        help="Laisser vide pour le tarif de référence par défaut")
+    price_list = fields.Many2One('product.price_list', 'Tarifaire',
+        required=True, ondelete='RESTRICT')
+
+    _get_price_list_cache = Cache(
+        'gnuhealth.insurance.reference_tariff.get_price_list', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('insurer_uniq', Unique(t, t.insurer),
+                'z_health_extra.msg_reference_tariff_insurer_unique'),
+            ]
+
+    @classmethod
+    def validate(cls, tariffs):
+        super().validate(tariffs)
+        cls.check_default()
+
+    @classmethod
+    def check_default(cls):
+        "Un seul tarif sans assureur"
+        if len(cls.search([('insurer', '=', None)], limit=2)) > 1:
+            raise ReferenceTariffValidationError(gettext(
+                    'z_health_extra.msg_reference_tariff_default_unique'))
+
+    @classmethod
+    def get_price_list(cls, insurer=None):
+        "Retourne le tarif de référence de l'assureur (ou celui par défaut)"
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        insurer_id = insurer.id if insurer else None
+        price_list_id = cls._get_price_list_cache.get(insurer_id, -1)
+        if price_list_id != -1:
+            return PriceList(price_list_id) if price_list_id else None
+
+        tariffs = []
+        if insurer_id:
+            tariffs = cls.search([('insurer', '=', insurer_id)], limit=1)
+        if not tariffs:
+            tariffs = cls.search([('insurer', '=', None)], limit=1)
+        if tariffs:
+            price_list_id = tariffs[0].price_list.id
+        else:
+            # Ancien comportement tant que rien n'est configuré
+            price_lists = PriceList.search([
+                    ('name', '=', 'PORT AUTONOME DE DOUALA'),
+                    ], limit=1)
+            price_list_id = price_lists[0].id if price_lists else None
+        cls._get_price_list_cache.set(insurer_id, price_list_id)
+        return PriceList(price_list_id) if price_list_id else None
+
+    @classmethod
+    def create(cls, vlist):
+        tariffs = super().create(vlist)
+        cls._get_price_list_cache.clear()
+        return tariffs
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._get_price_list_cache.clear()
+
+    @classmethod
+    def delete(cls, tariffs):
+        super().delete(tariffs)
+        cls._get_price_list_cache.clear()
+
+
 class PayInvoiceStart(metaclass=PoolMeta):
     'Pay Invoice'
     __name__ = 'account.invoice.pay.start'
@@ -201,12 +489,89 @@ class PayInvoice(metaclass=PoolMeta):
             return 'pay'
         return 'ask'
 
+    def transition_pay(self):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        state = super().transition_pay()
+        # Le versement modifie montant_verse, remboursement, etc.
+        Invoice._store_amount_cache(Invoice.browse([self.record.id]))
+        return state
+
 class TestType(metaclass=PoolMeta):
     'Type of Lab test'
     __name__ = 'gnuhealth.lab.test_type'
 
     test_type = fields.Many2One(
-        'gnuhealth.lab.type', 'Paillasse')
+        'gnuhealth.lab.type', 'Paillasse', select=True)
+
+    _analyte_template_cache = Cache(
+        'gnuhealth.lab.test_type.analyte_template')
+
+    @classmethod
+    def get_analyte_templates(cls, test_types):
+        """Valeurs prêtes à créer des analytes de chaque type de test:
+        {test_type_id: [valeurs]}"""
+        pool = Pool()
+        Critearea = pool.get('gnuhealth.lab.test.critearea')
+
+        templates = {}
+        missing = set()
+        for test_type_id in map(int, test_types):
+            template = cls._analyte_template_cache.get(test_type_id)
+            if template is None:
+                missing.add(test_type_id)
+            else:
+                templates[test_type_id] = template
+
+        new_templates = {i: [] for i in missing}
+        for sub_ids in grouped_slice(missing):
+            for critearea in Critearea.search([
+                        ('test_type_id', 'in', list(sub_ids)),
+                        ]):
+                new_templates[critearea.test_type_id.id].append({
+                        'name': critearea.name,
+                        'code': critearea.code,
+                        'sequence': critearea.sequence,
+                        'lower_limit': critearea.lower_limit,
+                        'upper_limit': critearea.upper_limit,
+                        'normal_range': critearea.normal_range,
+                        'units': critearea.units and critearea.units.id,
+                        })
+        for test_type_id, template in new_templates.items():
+            cls._analyte_template_cache.set(test_type_id, template)
+        templates.update(new_templates)
+        return templates
+
+
+class TestCritearea(metaclass=PoolMeta):
+    __name__ = 'gnuhealth.lab.test.critearea'
+
+    @classmethod
+    def _clear_analyte_template_cache(cls, criteareas=None, vlist=None):
+        "Vide le cache des modèles d'analytes si un type de test est touché"
+        pool = Pool()
+        TestType = pool.get('gnuhealth.lab.test_type')
+        if (any(c.test_type_id for c in criteareas or [])
+                or any(v.get('test_type_id') for v in vlist or [])):
+            TestType._analyte_template_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        criteareas = super().create(vlist)
+        cls._clear_analyte_template_cache(vlist=vlist)
+        return criteareas
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        for criteareas, values in zip(actions, actions):
+            cls._clear_analyte_template_cache(criteareas, [values])
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, criteareas):
+        cls._clear_analyte_template_cache(criteareas)
+        super().delete(criteareas)
 
 class LabTestType(ModelSQL, ModelView):
     'Lab Test Type'
@@ -214,12 +579,106 @@ class LabTestType(ModelSQL, ModelView):
 
     code = fields.Char('Code', required=True)
     name = fields.Char('Name', required=True)
+    pending = fields.Function(fields.Integer('Analyses en attente',
+            help="Analyses avec des résultats à saisir sur la période "
+            "start_date - end_date du contexte"), 'get_pending')
+
+    @classmethod
+    def _worklist_from(cls, benches=None, start_date=None, end_date=None):
+        """Jointure des analytes sans résultat des analyses demandées sur la
+        période avec leur type de test: (from, analyse, type, analyte, where)
+        """
+        pool = Pool()
+        Lab = pool.get('gnuhealth.lab')
+        TestType = pool.get('gnuhealth.lab.test_type')
+        Critearea = pool.get('gnuhealth.lab.test.critearea')
+        lab = Lab.__table__()
+        test_type = TestType.__table__()
+        critearea = Critearea.__table__()
+
+        where = ((critearea.result == Null)
+            & (Coalesce(critearea.result_text, '') == '')
+            & ((critearea.excluded == Null)
+                | (critearea.excluded == Literal(False))))
+        if benches is not None:
+            where &= reduce_ids(test_type.test_type, benches)
+        else:
+            where &= test_type.test_type != Null
+        if start_date:
+            where &= lab.date_requested >= datetime.combine(
+                start_date, datetime.min.time())
+        if end_date:
+            where &= lab.date_requested < datetime.combine(
+                end_date + timedelta(days=1), datetime.min.time())
+        from_ = critearea.join(lab,
+            condition=critearea.gnuhealth_lab_id == lab.id
+            ).join(test_type,
+            condition=lab.test == test_type.id)
+        return from_, lab, test_type, critearea, where
+
+    @classmethod
+    def worklist(cls, benches=None, start_date=None, end_date=None):
+        """Itère par paillasse puis par date de demande sur les analyses
+        en attente: (paillasse, analyse, [analytes sans résultat])"""
+        pool = Pool()
+        Lab = pool.get('gnuhealth.lab')
+        Critearea = pool.get('gnuhealth.lab.test.critearea')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        if benches is not None:
+            benches = [int(b) for b in benches]
+
+        from_, lab, test_type, critearea, where = cls._worklist_from(
+            benches, start_date, end_date)
+        cursor.execute(*from_.select(
+                test_type.test_type, lab.id, critearea.id,
+                where=where,
+                order_by=[test_type.test_type, lab.date_requested, lab.id,
+                    critearea.sequence, critearea.id]))
+
+        def browse(rows):
+            labs = Lab.browse([r[1] for r in rows])
+            criteareas = Critearea.browse([c for r in rows for c in r[2]])
+            analytes = iter(criteareas)
+            for (bench_id, _, critearea_ids), lab_ in zip(rows, labs):
+                yield cls(bench_id), lab_, [
+                    next(analytes) for _ in critearea_ids]
+
+        # Les analyses sont lues par paquets pour les grosses journées
+        size = transaction.database.IN_MAX
+        rows = []
+        for bench_id, lab_id, critearea_id in cursor:
+            if not rows or rows[-1][:2] != (bench_id, lab_id):
+                if len(rows) >= size:
+                    yield from browse(rows)
+                    rows = []
+                rows.append((bench_id, lab_id, []))
+            rows[-1][2].append(critearea_id)
+        if rows:
+            yield from browse(rows)
+
+    @classmethod
+    def get_pending(cls, benches, name):
+        "Nombre d'analyses en attente par paillasse sur la période du contexte"
+        context = Transaction().context
+        cursor = Transaction().connection.cursor()
+        pending = dict.fromkeys(map(int, benches), 0)
+        for sub_ids in grouped_slice(benches):
+            from_, lab, test_type, _, where = cls._worklist_from(
+                list(map(int, sub_ids)), context.get('start_date'),
+                context.get('end_date'))
+            cursor.execute(*from_.select(
+                    test_type.test_type, Count(lab.id, distinct=True),
+                    where=where, group_by=test_type.test_type))
+            pending.update(cursor)
+        return pending
 
 class Commission(metaclass=PoolMeta):
     __name__ = "commission"
 
     is_validate = fields.Boolean("Validé ", help="Cette case est coché si cette commission a été validé ou pas.")
 
+    @report_cached
     def bordereau_commission(self, records):
         # exemplaire de sortie canevas
         # liste_prix = ["Montant_prime_ht", "taxe", "Net_a_payer"]
@@ -278,6 +737,66 @@ class Invoice(metaclass=PoolMeta):
 
     tarifaire = fields.Many2One('product.price_list','Tarifaire', required=False)
 
+    montant_patient_cache = fields.Numeric('Montant Client Cache',
+        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'],
+        readonly=True, select=True)
+    total_amount2_cache = fields.Numeric('Total Avec Assurance Cache',
+        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'],
+        readonly=True, select=True)
+    montant_verse_cache = fields.Numeric('Montant Versé Cache',
+        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'],
+        readonly=True)
+    remboursement_cache = fields.Numeric('Remboursement Cache',
+        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'],
+        readonly=True)
+    dernier_versement_cache = fields.Numeric('Dernier Versement Cache',
+        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'],
+        readonly=True)
+    amount_cached = fields.Boolean('Montants Enregistrés', readonly=True,
+        help="Les montants cache sont à jour, même vides")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._check_modify_exclude |= {
+            name + '_cache' for name in AMOUNT_CACHE_FIELDS}
+        cls._check_modify_exclude.add('amount_cached')
+
+    @staticmethod
+    def default_amount_cached():
+        return False
+
+    @classmethod
+    def copy(cls, invoices, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        for name in AMOUNT_CACHE_FIELDS:
+            default.setdefault(name + '_cache', None)
+        default.setdefault('amount_cached', False)
+        return super().copy(invoices, default=default)
+
+    @classmethod
+    def _post(cls, invoices):
+        super()._post(invoices)
+        cls._store_amount_cache(invoices)
+
+    @classmethod
+    def paid(cls, invoices):
+        super().paid(invoices)
+        cls._store_amount_cache(invoices)
+
+    @classmethod
+    def cancel(cls, invoices):
+        super().cancel(invoices)
+        cls._store_amount_cache(invoices)
+
+    @classmethod
+    def draft(cls, invoices):
+        super().draft(invoices)
+        cls._clear_amount_cache(invoices)
+
     @classmethod
     def credit(cls, invoices, refund=False, **values):
         '''
@@ -310,162 +829,122 @@ class Invoice(metaclass=PoolMeta):
     #     cls.create_commissions(to_commission)
 
     @classmethod
-    def contact(self, id):
+    def contact(cls, id):
+        pool = Pool()
+        Patient = pool.get('gnuhealth.patient')
+        party_id = Patient(id).name.id
+        return cls.contacts_for([party_id])[party_id]
 
-        transaction = Transaction()
-        cursor = transaction.connection.cursor()
-        #cursor = conn2.cursor()
-        f = cursor.execute("SELECT current_database()")
-        database_name = cursor.fetchone()[0]
-        #sql = "SELECT type, value FROM party_contact_mechanism JOIN party_party ON party_contact_mechanism.party = party_party.id JOIN gnuhealth_patient ON {} = gnuhealth_patient.id".format(id)
-        sql1 = "SELECT name FROM gnuhealth_patient where gnuhealth_patient.id = {}".format(id)
-        cursor.execute(sql1)
-        data1 = cursor.fetchone()
-        sql2 = "SELECT type, value FROM party_contact_mechanism WHERE party = {}".format(data1[0])
-        cursor.execute(sql2)
-        data2 = cursor.fetchall()
-        #print("Les différentes données ", data2[0][0])
-
-        list_phone = []
-        for item in data2 :
-            if item[0] == "phone" :
-                list_phone.append(item[1])
-
-        return ("/ ".join(list_phone))
-    
     @classmethod
-    def contact2(self, id):
+    def contact2(cls, id):
+        return cls.contacts_for([id])[id]
 
-        transaction = Transaction()
-        cursor = transaction.connection.cursor()
-        #cursor = conn2.cursor()
-        f = cursor.execute("SELECT current_database()")
-        database_name = cursor.fetchone()[0]
-        #sql = "SELECT type, value FROM party_contact_mechanism JOIN party_party ON party_contact_mechanism.party = party_party.id JOIN gnuhealth_patient ON {} = gnuhealth_patient.id".format(id)
-        sql2 = "SELECT type, value FROM party_contact_mechanism WHERE party = {}".format(id)
-        cursor.execute(sql2)
-        data2 = cursor.fetchall()
-        #print("Les différentes données ", data2[0][0])
-
-        list_phone = []
-        for item in data2 :
-            if item[0] == "phone" :
-                list_phone.append(item[1])
+    @classmethod
+    @report_cached
+    def contacts_for(cls, party_ids):
+        """Téléphones des parties {id: "tel1/ tel2"} en une requête,
+        gardés pour le reste de l'impression"""
+        pool = Pool()
+        ContactMechanism = pool.get('party.contact_mechanism')
+        mechanism = ContactMechanism.__table__()
+        cursor = Transaction().connection.cursor()
 
-        return ("/ ".join(list_phone))
+        phones = defaultdict(list)
+        for sub_ids in grouped_slice(set(party_ids)):
+            cursor.execute(*mechanism.select(
+                    mechanism.party, mechanism.value,
+                    where=reduce_ids(mechanism.party, sub_ids)
+                    & (mechanism.type == 'phone'),
+                    order_by=[mechanism.party, mechanism.id]))
+            for party_id, value in cursor:
+                phones[party_id].append(value)
+        return {i: "/ ".join(phones[i]) for i in party_ids}
 
     @classmethod
     def create_commissions(cls, invoices):
+        if invoices and cls._commission_queue_enabled():
+            # Calculées par ir.queue après la validation de la facture
+            cls.__queue__.create_commissions_queued(invoices)
+            return []
+        return cls.create_commissions_queued(invoices)
+
+    @staticmethod
+    def _commission_queue_enabled():
+        return config.getboolean(
+            'z_health_extra', 'commission_queue', default=False)
+
+    @classmethod
+    def create_commissions_queued(cls, invoices):
+        "Crée les commissions qui n'existent pas encore pour ces factures"
         pool = Pool()
         Commission = pool.get('commission')
-        # Enlever ceci après la fin des travaux
-        all_commissions = []
-        for invoice in invoices:
-            for line in invoice.lines:
-                commissions = line.get_commissions()
-                if commissions:
-                    all_commissions.extend(commissions)
+        InvoiceLine = pool.get('account.invoice.line')
+        cls.lock(invoices)
+        lines = [line for invoice in invoices
+            if invoice.state in {'posted', 'paid'}
+            for line in invoice.lines]
+        existing = set()
+        for sub_lines in grouped_slice(lines):
+            for commission in Commission.search([
+                        ('origin', 'in', [str(l) for l in sub_lines]),
+                        ]):
+                existing.add((commission.origin, commission.agent))
+        all_commissions = [c for c in InvoiceLine.get_commissions_many(lines)
+            if (c.origin, c.agent) not in existing]
 
         Commission.save(all_commissions)
         return all_commissions
 
     @staticmethod
     def lab_requests2(reference):
-        LabTest = Pool().get('gnuhealth.patient.lab.test')
-        TestRequest = Pool().get('gnuhealth.patient.lab.test')
-        Lab = Pool().get('gnuhealth.lab')
-
-        tests_report_data = []
-
-        tests = TestRequest.search([('service.name', '=', reference)])
-
-        for lab_test_order in tests:
-
-            test_cases = []
-            test_report_data = {}
-
-            if lab_test_order.state == 'ordered':
-                break
-
-            test_report_data['test'] = lab_test_order.name.id
-            test_report_data['patient'] = lab_test_order.patient_id.id
-            if lab_test_order.doctor_id:
-                test_report_data['requestor'] = lab_test_order.doctor_id.id
-            test_report_data['date_requested'] = lab_test_order.date
-            test_report_data['request_order'] = lab_test_order.request
-
-            for critearea in lab_test_order.name.critearea:
-                test_cases.append(('create', [{
-                        'name': critearea.name,
-                        'sequence': critearea.sequence,
-                        'lower_limit': critearea.lower_limit,
-                        'upper_limit': critearea.upper_limit,
-                        'normal_range': critearea.normal_range,
-                        'units': critearea.units and critearea.units.id,
-                    }]))
-            test_report_data['critearea'] = test_cases
-
-            tests_report_data.append(test_report_data)
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        return Invoice.service_requests([reference])['lab'][reference]
 
-        with Transaction().new_transaction():
-            Lab.create(tests_report_data)
-            TestRequest.write(tests, {'state': 'ordered'})
-        return LabTest.search([('service.name', '=', reference)])
-    
     @staticmethod
     def img_requests2(reference):
-        ImagingRequest = Pool().get('gnuhealth.imaging.test.request')
-        Request = Pool().get('gnuhealth.imaging.test.request')
-        Result = Pool().get('gnuhealth.imaging.test.result')
-        action = []
-        request_data = []
-        requests = Request.search([('service.name', '=', reference)])
-        for request in requests:
-            request_data.append({
-                'patient': request.patient.id,
-                'date': datetime.now(),
-                'request_date': request.date,
-                'requested_test': request.requested_test,
-                'request': request.id,
-                'order': request.request,
-                'doctor': request.doctor})
-        with Transaction().new_transaction():
-            results = Result.create(request_data)
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        return Invoice.service_requests([reference])['img'][reference]
 
-        action['pyson_domain'] = PYSONEncoder().encode(
-            [('id', 'in', [r.id for r in results])])
+    @staticmethod
+    def exp_requests2(reference):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        return Invoice.service_requests([reference])['exp'][reference]
 
+    @classmethod
+    @report_cached
+    def service_requests(cls, references):
+        """Commande en une fois les demandes de laboratoire, d'imagerie et
+        d'explorations des services et les retourne par type et par service:
+        {'lab'|'img'|'exp': {référence: [demandes]}}"""
+        pool = Pool()
+        kinds = [
+            ('lab', 'gnuhealth.patient.lab.test', cls.lab_requests_many),
+            ('img', 'gnuhealth.imaging.test.request', cls.img_requests_many),
+            ('exp', 'gnuhealth.patient.exp.test', cls.exp_requests_many),
+            ]
+        references = sorted(set(references) - {None})
+        # Appelé depuis les rapports qui s'exécutent en lecture seule
         with Transaction().new_transaction():
-            Request.requested(requests)
-            Request.done(requests)
-        return ImagingRequest.search([('service.name', '=', reference)])
-    
+            for _, _, requests_many in kinds:
+                requests_many(references)
+
+        result = {}
+        for kind, model, _ in kinds:
+            Request = pool.get(model)
+            requests = result[kind] = defaultdict(list)
+            for sub_references in grouped_slice(references):
+                for request in Request.search([
+                            ('service.name', 'in', list(sub_references)),
+                            ]):
+                    requests[request.service.name].append(request)
+        return result
+
     @staticmethod
-    def exp_requests2(reference):
-        ExpTest = Pool().get('gnuhealth.patient.exp.test')
-        TestRequest = Pool().get('gnuhealth.patient.exp.test')
-        Explo = Pool().get('gnuhealth.exp')
-        tests_report_data = []
-        tests = TestRequest.search([('service.name', '=', reference)]) 
-        for explo_test_order in tests:
-
-            test_cases = []
-            test_report_data = {}
-
-            if explo_test_order.state == 'ordered':
-                break
-
-            test_report_data['test'] = explo_test_order.name.id
-            test_report_data['source_type'] = explo_test_order.source_type
-            test_report_data['patient'] = explo_test_order.patient_id and explo_test_order.patient_id.id
-            test_report_data['other_source'] = explo_test_order.other_source
-            if explo_test_order.doctor_id:
-                test_report_data['requestor'] = explo_test_order.doctor_id.id
-            test_report_data['date_requested'] = explo_test_order.date
-            test_report_data['request_order'] = explo_test_order.request
-
-            for critearea in explo_test_order.name.critearea:
-                test_cases.append(('create', [{
+    def _critearea_values(test_type):
+        return [('create', [{
                         'name': critearea.name,
                         'code': critearea.code,
                         'sequence': critearea.sequence,
@@ -473,17 +952,95 @@ class Invoice(metaclass=PoolMeta):
                         'upper_limit': critearea.upper_limit,
                         'normal_range': critearea.normal_range,
                         'units': critearea.units and critearea.units.id,
-                    }]))
-            test_report_data['critearea'] = test_cases
+                        } for critearea in test_type.critearea])]
 
-            tests_report_data.append(test_report_data)
-
-        with Transaction().new_transaction():
-            Explo.create(tests_report_data)
+    @classmethod
+    def lab_requests_many(cls, references):
+        """Crée en une fois les analyses des demandes de laboratoire non
+        commandées des services et les passe à l'état commandé.
+        Retourne les demandes des services."""
+        pool = Pool()
+        TestRequest = pool.get('gnuhealth.patient.lab.test')
+        TestType = pool.get('gnuhealth.lab.test_type')
+        Lab = pool.get('gnuhealth.lab')
+        Critearea = pool.get('gnuhealth.lab.test.critearea')
+        references = list(references)
+
+        tests = TestRequest.search([
+                ('service.name', 'in', references),
+                ('state', '!=', 'ordered'),
+                ])
+        labs = Lab.create([{
+                    'test': test.name.id,
+                    'patient': test.patient_id.id,
+                    'requestor': test.doctor_id and test.doctor_id.id,
+                    'date_requested': test.date,
+                    'request_order': test.request,
+                    } for test in tests])
+        templates = TestType.get_analyte_templates([t.name for t in tests])
+        Critearea.create([dict(values, gnuhealth_lab_id=lab.id)
+                for test, lab in zip(tests, labs)
+                for values in templates[test.name.id]])
+        if tests:
             TestRequest.write(tests, {'state': 'ordered'})
+        return TestRequest.search([('service.name', 'in', references)])
 
-        return ExpTest.search([('service.name', '=', reference)])    
+    @classmethod
+    def exp_requests_many(cls, references):
+        """Crée en une fois les explorations des demandes non commandées des
+        services et les passe à l'état commandé.
+        Retourne les demandes des services."""
+        pool = Pool()
+        TestRequest = pool.get('gnuhealth.patient.exp.test')
+        Explo = pool.get('gnuhealth.exp')
+        references = list(references)
+
+        tests = TestRequest.search([
+                ('service.name', 'in', references),
+                ('state', '!=', 'ordered'),
+                ])
+        Explo.create([{
+                    'test': test.name.id,
+                    'source_type': test.source_type,
+                    'patient': test.patient_id and test.patient_id.id,
+                    'other_source': test.other_source,
+                    'requestor': test.doctor_id and test.doctor_id.id,
+                    'date_requested': test.date,
+                    'request_order': test.request,
+                    'critearea': cls._critearea_values(test.name),
+                    } for test in tests])
+        if tests:
+            TestRequest.write(tests, {'state': 'ordered'})
+        return TestRequest.search([('service.name', 'in', references)])
 
+    @classmethod
+    def img_requests_many(cls, references):
+        """Crée en une fois les résultats des demandes d'imagerie non
+        terminées des services et les passe à l'état terminé.
+        Retourne les demandes des services."""
+        pool = Pool()
+        Request = pool.get('gnuhealth.imaging.test.request')
+        Result = pool.get('gnuhealth.imaging.test.result')
+        references = list(references)
+
+        requests = Request.search([
+                ('service.name', 'in', references),
+                ('state', '!=', 'done'),
+                ])
+        now = datetime.now()
+        Result.create([{
+                    'patient': request.patient.id,
+                    'date': now,
+                    'request_date': request.date,
+                    'requested_test': request.requested_test.id,
+                    'request': request.id,
+                    'order': request.request,
+                    'doctor': request.doctor and request.doctor.id,
+                    } for request in requests])
+        if requests:
+            Request.requested(requests)
+            Request.done(requests)
+        return Request.search([('service.name', 'in', references)])
 
     @fields.depends('dernier_versement')
     def on_change_with_montant_en_lettre(self):
@@ -493,35 +1050,80 @@ class Invoice(metaclass=PoolMeta):
     def convert_letter(name):
         return num2words(name, lang='fr').capitalize()
     
+    def get_reference_tariff(self):
+        "Tarif de référence de l'assureur de la facture"
+        pool = Pool()
+        ReferenceTariff = pool.get('gnuhealth.insurance.reference_tariff')
+        insurer = None
+        if (self.health_service
+                and self.health_service.insurance_plan):
+            insurer = self.health_service.insurance_plan.company
+        price_list = ReferenceTariff.get_price_list(insurer)
+        if not price_list:
+            if insurer:
+                raise ReferenceTariffError(gettext(
+                        'z_health_extra.msg_reference_tariff_missing',
+                        insurer=insurer.rec_name))
+            raise ReferenceTariffError(gettext(
+                    'z_health_extra.msg_reference_tariff_default_missing'))
+        return price_list
+
     @staticmethod
     def calcul_prix_MSH(party, line):
-        pool = Pool()
         # Liste de sortie
         # elt = [indice, prix_unitaire, qte, montant_total]
-        elt = []
-        elt.append(line.product.list_price)
-        Product_Price_List = pool.get("product.price_list")
-        sale_price_list = Product_Price_List.search([
-                ('name', '=', 'PORT AUTONOME DE DOUALA'),
-                ], limit=1)
-        unit_price = sale_price_list[0].compute(
-                            party,
-                            line.product, line.product.list_price,
-                            line.quantity, line.product.default_uom)
-        elt.append(unit_price)
-        elt.append(line.quantity)
-        elt.append(elt[1]*Decimal(elt[2]))
-        return elt
-    
+        Invoice = Pool().get('account.invoice')
+        if party == line.invoice.party:
+            return Invoice.calcul_prix_lignes_MSH([line.invoice])[line.id]
+        return Invoice._calcul_prix_MSH([(party, line)])[0]
+
+    @classmethod
+    def _calcul_prix_MSH(cls, party_lines):
+        """Prix MSH de [(partie, ligne)], les lignes d'un même tarif et d'une
+        même partie en un seul calcul:
+        [[indice, prix_unitaire, qte, montant_total]]"""
+        groups = defaultdict(list)
+        for position, (party, line) in enumerate(party_lines):
+            groups[(line.invoice.get_reference_tariff(), party)].append(
+                position)
+        result = [None] * len(party_lines)
+        for (price_list, party), positions in groups.items():
+            lines = [party_lines[p][1] for p in positions]
+            unit_prices = price_list.compute_many(party, [
+                    (l.product, l.quantity, l.product.default_uom)
+                    for l in lines])
+            for position, line, unit_price in zip(
+                    positions, lines, unit_prices):
+                result[position] = [line.product.list_price, unit_price,
+                    line.quantity, unit_price*Decimal(line.quantity)]
+        return result
+
+    @classmethod
+    @report_cached
+    def calcul_prix_lignes_MSH(cls, invoices):
+        """Prix MSH des lignes des factures, calculés une fois pour toute
+        l'impression: {line_id: [indice, prix_unitaire, qte, montant_total]}
+        """
+        lines = [l for i in invoices for l in i.lines]
+        return dict(zip((l.id for l in lines), cls._calcul_prix_MSH(
+                    [(l.invoice.party, l) for l in lines])))
+
     @classmethod
+    @report_cached
     def calcul_prix_total_MSH(cls, record):
+        return cls.calcul_prix_totaux_MSH([record])[record.id]
+
+    @classmethod
+    @report_cached
+    def calcul_prix_totaux_MSH(cls, invoices):
+        "Totaux MSH par facture, calculés une fois pour toute l'impression"
+        prices = cls.calcul_prix_lignes_MSH(invoices)
+        totals = {i.id: 0 for i in invoices}
+        for invoice in invoices:
+            for line in invoice.lines:
+                totals[invoice.id] += prices[line.id][3]
+        return totals
 
-        total = 0
-        for line in record.lines :
-            elt = cls.calcul_prix_MSH(record.party, line)
-            total = total + elt[3]
-        return total
-    
     @classmethod
     def calcul_prix_preferentiel_MSH(cls, total, record=None):
 
@@ -534,184 +1136,202 @@ class Invoice(metaclass=PoolMeta):
 
 
     def total_synth_facture_assurance(self, records):
-        return self._total_synth_facture_filtered(records, insurance=True)
+        return self.synthesis_totals(records).assurance
 
     def total_synth_facture_pdmd(self, records):
-        return self._total_synth_facture_filtered(records, insurance=False)
+        return self.synthesis_totals(records).pdmd
     
     def total_synth_facture_credit(self, records):
-        elements = []
-        total_amount = Decimal(0)
-        montant_assurance = Decimal(0)
-        z_remise2 = Decimal(0)
-        net_a_payer = Decimal(0)
-        amount_to_pay = Decimal(0)
-        difference = Decimal(0)
-        total_amount2 = Decimal(0)
+        return self.synthesis_totals(records).credit
 
-        for record in records:
-            if record.health_service :
-                continue
-            total_amount += record.untaxed_amount or Decimal(0)
-            montant_assurance += record.montant_assurance or Decimal(0)
-            net_a_payer += record.montant_patient or Decimal(0)
-            amount_to_pay += record.amount_to_pay or Decimal(0)
-            total_amount2 += Decimal(record.untaxed_amount or 0) + Decimal(record.montant_assurance or 0)
-        
-        difference = net_a_payer - amount_to_pay
-        
-        elements.extend([
-            total_amount,
-            montant_assurance,
-            z_remise2,
-            net_a_payer,
-            difference,
-            amount_to_pay,
-            total_amount2
-        ])
-        
-        return elements
-
-    def _total_synth_facture_filtered(self, records, insurance=True):
-        # Exemplaire de sortie de liste 
-        # elements2 = ["total_amount", "montant_assurance", "Remise",  "montant_patient-amount_to_pay", "montant_patient", "amount_to_pay"]
-        # elements = ["total_amount" , "montant_assurance", "montant_patient", "montant_patient-amount_to_pay", "amount_to_pay"]
+    @classmethod
+    @report_cached
+    def synthesis_totals(cls, records):
+        """Totaux de synthèse des factures assurance, PDMD et crédit (sans
+        service) en une passe, gardés pour le reste de l'impression.
+        Chaque total se lit comme l'ancienne liste:
+        [total_amount, montant_assurance, z_remise2, net_a_payer,
+        difference, amount_to_pay, total_amount2]"""
+        invoices = cls.browse([r.id for r in records])
+        services = cls._get_synthesis_services(invoices)
+        untaxed = cls.get_amount(invoices, ['untaxed_amount'])[
+            'untaxed_amount']
+        montant_patient = cls.get_amount_with_insurance(
+            invoices, ['montant_patient'])['montant_patient']
+        amount_to_pay = cls.get_amount_to_pay(invoices, 'amount_to_pay')
+
+        buckets = {name: [Decimal(0)] * 7
+            for name in ['assurance', 'pdmd', 'credit']}
+        for invoice in invoices:
+            if invoice.id in services:
+                insurance_plan, z_remise2 = services[invoice.id]
+                bucket = buckets['assurance' if insurance_plan else 'pdmd']
+                bucket[2] += z_remise2 or Decimal(0)
+            else:
+                bucket = buckets['credit']
+            bucket[0] += untaxed[invoice.id] or Decimal(0)
+            bucket[1] += invoice.montant_assurance or Decimal(0)
+            bucket[3] += montant_patient[invoice.id] or Decimal(0)
+            bucket[5] += amount_to_pay[invoice.id] or Decimal(0)
+            bucket[6] += (Decimal(untaxed[invoice.id] or 0)
+                + Decimal(invoice.montant_assurance or 0))
+        for bucket in buckets.values():
+            bucket[4] = bucket[3] - bucket[5]
+
+        return SynthesisTotals(**{name: SynthesisBucket(*bucket)
+                for name, bucket in buckets.items()})
 
-        elements = []
-        total_amount = Decimal(0)
-        montant_assurance = Decimal(0)
-        z_remise2 = Decimal(0)
-        net_a_payer = Decimal(0)
-        amount_to_pay = Decimal(0)
-        difference = Decimal(0)
-        total_amount2 = Decimal(0)
+    @classmethod
+    def _get_synthesis_services(cls, invoices):
+        """Plan d'assurance et remise du service de chaque facture issue
+        d'un service: {invoice_id: (insurance_plan, z_remise2)}"""
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        ServiceLine = pool.get('gnuhealth.health_service.line')
+        HealthService = pool.get('gnuhealth.health_service')
+        line = InvoiceLine.__table__()
+        service_line = ServiceLine.__table__()
+        service = HealthService.__table__()
+        cursor = Transaction().connection.cursor()
 
-        for record in records:
-            if record.health_service :
-                if bool(record.health_service.insurance_plan) != insurance:
-                    continue
-                total_amount += record.untaxed_amount or Decimal(0)
-                montant_assurance += record.montant_assurance or Decimal(0)
-                z_remise2 += record.health_service.z_remise2 or Decimal(0)
-                net_a_payer += record.montant_patient or Decimal(0)
-                amount_to_pay += record.amount_to_pay or Decimal(0)
-                total_amount2 += Decimal(record.untaxed_amount or 0) + Decimal(record.montant_assurance or 0)
-        
-        difference = net_a_payer - amount_to_pay
-        
-        elements.extend([
-            total_amount,
-            montant_assurance,
-            z_remise2,
-            net_a_payer,
-            difference,
-            amount_to_pay,
-            total_amount2
-        ])
-        
-        return elements
+        # L'identifiant est extrait de l'origine pour joindre sur la clé
+        origin_id = ServiceLine.id.sql_cast(
+            Substring(line.origin, Position(',', line.origin) + Literal(1)))
+        services = {}
+        for sub_ids in grouped_slice(invoices):
+            cursor.execute(*line.join(service_line,
+                    condition=service_line.id == origin_id
+                    ).join(service,
+                    condition=service_line.name == service.id
+                    ).select(line.invoice, service.insurance_plan,
+                    service.z_remise2,
+                    where=reduce_ids(line.invoice, sub_ids)
+                    & line.origin.like(ServiceLine.__name__ + ',%'),
+                    order_by=[line.invoice, line.sequence, line.id]))
+            for invoice_id, insurance_plan, z_remise2 in cursor:
+                if z_remise2 is not None and not isinstance(
+                        z_remise2, Decimal):
+                    z_remise2 = Decimal(str(z_remise2))
+                services.setdefault(invoice_id, (insurance_plan, z_remise2))
+        return services
 
+    @staticmethod
     def get_category_one_before_root(category):
         """Remonte jusqu'à la catégorie dont le parent est racine (parent.parent is None)."""
-        if not category or not category.parent:
-            return category  # Déjà racine ou sans parent
-        while category.parent and category.parent.parent:
-            category = category.parent
-        return category
-
+        Category = Pool().get('product.category')
+        return Category.get_top_level(category)
 
+    @report_cached
     def get_sales_by_root_category(self, records, start_date=None, end_date=None):
-
+        "Ventes des factures par catégorie racine: [{nom: montant}]"
         pool = Pool()
-        Invoices = pool.get('account.invoice')
-
-        listes_factures = []
-        for Facture in records:
-            if Facture.number not in listes_factures:
-                listes_factures.append(Facture.number)
-        
-        for Facture in records:
-            if Facture.reference in listes_factures:
-                listes_factures.remove(Facture.reference)
-                listes_factures.remove(Facture.number)
+        Category = pool.get('product.category')
+        SalesRollup = pool.get('account.invoice.sales_rollup')
 
+        top_level = Category.get_top_level_map()
         category_totals = defaultdict(Decimal)
-
-        for number in listes_factures:
-            facture = Invoices.search([('number', '=', number)], limit=1)
+        for facture in self.net_invoices(records):
+            if start_date and facture.invoice_date < start_date:
+                continue
+            if end_date and facture.invoice_date > end_date:
+                continue
             for line in facture.lines:
-                product = line.product
-                if not product:
-                    continue  # Ignore les lignes sans produit
-                category = product.category
+                if line.type != 'line':
+                    continue
+                category = SalesRollup.get_category(line.product)
                 if not category:
-                    continue  # Ignore les produits sans catégorie
-                root_category = self.get_category_one_before_root(category)
+                    continue  # Ignore les lignes sans catégorie
                 amount = line.amount or Decimal(0)
-                category_totals[root_category.name] += amount
+                category_totals[top_level[category.id]] += amount
+
+        name_totals = defaultdict(Decimal)
+        for category in Category.browse(list(category_totals)):
+            name_totals[category.name] += category_totals[category.id]
 
         # Convertit en liste de dictionnaires
-        result = [{k: v} for k, v in category_totals.items()]
-        return result 
-    
+        return [{k: v} for k, v in name_totals.items()]
 
     def part_patient_assurance(self, records=None, record=None, line=None) :
+        split = self._split_insurance(record, line, line.montant_produit())
+        return [split.assurance, split.patient]
 
-        montant_total = float(0)
-        montant_produit_patient = float(0)
-        montant_produit_assurance = float(0)
-        elt = []
-
-        if float(record.untaxed_amount) <= float(2):
-            montant_total = float(record.montant_assurance)
-            montant_produit_patient = float(0)
-            montant_produit_assurance = float(line.montant_produit())*float(line.quantity)
-        else :
-            montant_total = float(record.untaxed_amount) + float(record.montant_assurance)
-            pourcentage_patient = float(record.untaxed_amount) / montant_total
-            pourcentage_assurance = float(record.montant_assurance) / montant_total
+    @staticmethod
+    def _split_insurance(invoice, line, unit_price):
+        "Part assurance et part patient d'une ligne au prix tarifaire"
+        untaxed_amount = invoice.untaxed_amount or Decimal(0)
+        montant_assurance = invoice.montant_assurance or Decimal(0)
+        amount = unit_price * Decimal(str(line.quantity or 0))
+
+        montant_total = untaxed_amount + montant_assurance
+        if untaxed_amount <= 2 or not montant_total:
+            assurance, patient = amount, Decimal(0)
+        else:
+            assurance = amount * montant_assurance / montant_total
+            patient = amount * untaxed_amount / montant_total
+        return InsuranceSplit(invoice, line,
+            invoice.currency.round(assurance),
+            invoice.currency.round(patient))
 
-            montant_produit_patient = (float(line.montant_produit()) * pourcentage_patient)*float(line.quantity)
-            montant_produit_assurance = (float(line.montant_produit()) * pourcentage_assurance)*float(line.quantity)
-            
-        elt.extend([montant_produit_assurance, montant_produit_patient])
-        
-        return elt
-    
+    @classmethod
+    def split_insurance(cls, invoices):
+        """Part assurance et part patient de toutes les lignes des factures
+        avec un seul calcul de prix par ligne.
+        Retourne ([total assurance, total patient], [InsuranceSplit])"""
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        lines = [(invoice, line)
+            for invoice in invoices for line in invoice.lines]
+        unit_prices = InvoiceLine.montants_produits([l for _, l in lines])
+
+        rows = [cls._split_insurance(invoice, line, unit_price)
+            for (invoice, line), unit_price in zip(lines, unit_prices)]
+        totals = [sum((r.assurance for r in rows), Decimal(0)),
+            sum((r.patient for r in rows), Decimal(0))]
+        return totals, rows
+
+    @report_cached
     def total_part_patient_assurance(self, records=None):
+        totals, _ = self.split_insurance(records or [])
+        return totals
 
-        total_part_assurance = float(0)
-        total_part_patient = float(0)
-        elt = []
-        for record in records:
-            for line in record.lines:
-                total_part_assurance += self.part_patient_assurance(record=record, line=line)[0]
-                total_part_patient += self.part_patient_assurance(record=record, line=line)[1]
-
-        elt.extend([total_part_assurance, total_part_patient])
-
-        return elt 
-
+    @report_cached
     def facture_reelles(self, records):
-        list_of_save_elements = []
-        listes_factures = []
-        for Facture in records:
-            if Facture.number not in listes_factures:
-                listes_factures.append(Facture.number)
-        
-        for Facture in records:
-            if Facture.reference in listes_factures:
-                listes_factures.remove(Facture.reference)
-                listes_factures.remove(Facture.number)
+        return list(self.net_invoices(records))
 
-        for elt in listes_factures:
-            Invoices = Pool().get("account.invoice")
-            facture = Invoices.search([('number', '=', elt)], limit=1)
-            list_of_save_elements.append(facture[0])
+    @classmethod
+    def net_invoices(cls, records):
+        """Itère sur les factures qui ne sont pas annulées par un avoir
+        présent dans records: une facture et l'avoir dont la référence est
+        son numéro s'annulent. Une seule facture est gardée par numéro."""
+        cursor = Transaction().connection.cursor()
+        invoice = cls.__table__()
 
-        return list_of_save_elements
-    
+        numbers = {}
+        references = set()
+        for sub_ids in grouped_slice([r.id for r in records]):
+            cursor.execute(*invoice.select(
+                    invoice.id, invoice.number, invoice.reference,
+                    where=reduce_ids(invoice.id, sub_ids)))
+            for invoice_id, number, reference in cursor:
+                numbers[invoice_id] = number
+                if reference:
+                    references.add((number, reference))
+
+        numbers_set = set(numbers.values())
+        excluded = set()
+        for number, reference in references:
+            if reference in numbers_set:
+                excluded.update([number, reference])
+
+        seen = set()
+        for record in records:
+            number = numbers[record.id]
+            if number in excluded or number in seen:
+                continue
+            seen.add(number)
+            yield record
 
+    @report_cached
     def total_facture_par_produits(self, records):
         # Exemplaire de sortie de liste 
         # elements = ["total_amount" , "montant_assurance", "montant_patient", "montant_patient-amount_to_pay", "amount_to_pay"]
@@ -747,118 +1367,165 @@ class Invoice(metaclass=PoolMeta):
         else :
             return n
 
+    @report_cached
     def commission_Banque(self, records):
-
+        # {"NOM PRENOM": [montant, numero_carte, clef]} trié par nom
+        # Les montants des comptes d'un même docteur sont additionnés
         liste_docteurs = {}
-        for record in records:
-            if record.party.clef:
-                if len(record.party.clef) != 0 :
-                    docteur = record.party.name+" "+record.party.lastname
-                    list_element = []
-                    for line in record.lines:
-                        if docteur in liste_docteurs.keys():
-                            liste_docteurs[docteur][0] = int(liste_docteurs[docteur][0] + line.amount)
-                            liste_docteurs[docteur][1] = record.party.numero_carte
-                            liste_docteurs[docteur][2] = record.party.clef
-                        else:
-                            list_element.append(int(line.amount))
-                            list_element.append(record.party.numero_carte)
-                            list_element.append(record.party.clef)
-                            liste_docteurs[docteur] = list_element
-
-        sorted_items = sorted(liste_docteurs.items(), key=lambda x: x[0])
-
-        return dict(sorted_items)     
+        for name, numero_carte, clef, _, amount in self.bank_transfers(
+                records):
+            if name in liste_docteurs:
+                amount += liste_docteurs[name][0]
+            liste_docteurs[name] = [amount, numero_carte, clef]
+        return dict(sorted(liste_docteurs.items(), key=lambda x: x[0]))
 
-    def commission_docteur(self, records):
-        # Le modèle de sortie de la liste des docteurs : 
-        # {"JUDITH": (montant, impot, net_a_payer), "FRED": (montant, impot, net_a_payer), "MARINA": (montant, impot, net_a_payer)}
-        liste_docteurs = {}
-        for record in records:
-            if record.party.clef == None or record.party.clef == "":
-                docteur = record.party.name+" "+record.party.lastname
-                list_element = []
-                for line in record.lines:
-                    if docteur in liste_docteurs.keys():
-                        liste_docteurs[docteur][0] = int(liste_docteurs[docteur][0] + line.unit_price)
-                        liste_docteurs[docteur][1] = int(liste_docteurs[docteur][1] + (0.11*float(line.unit_price)))
-                        liste_docteurs[docteur][2] = int(liste_docteurs[docteur][2] + line.amount)
-                        liste_docteurs[docteur][3] = self.contact2(id=record.party.id)
-                    else:
-                        list_element.append(int(line.unit_price))
-                        list_element.append(int(0.11*float(line.unit_price)))
-                        list_element.append(int(line.amount))
-                        list_element.append(self.contact2(id=record.party.id))
-                        liste_docteurs[docteur] = list_element
-            
-        totaux = [0] * len(next(iter(liste_docteurs.values())))  # Crée une liste de zéros de la même longueur que les listes
+    @classmethod
+    def bank_transfers(cls, records):
+        """Génère (nom, numero_carte, clef, devise, montant) par compte
+        bancaire des parties ayant une clef, agrégé en SQL"""
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        Currency = pool.get('currency.currency')
+        Party = pool.get('party.party')
+        invoice = cls.__table__()
+        line = InvoiceLine.__table__()
+        currency = Currency.__table__()
+        party = Party.__table__()
+        cursor = Transaction().connection.cursor()
+        type_name = cls.total_amount._field.sql_type().base
 
-        # Calcul des totaux
-        for valeurs in liste_docteurs.values():
-            for i in range(len(valeurs)-1):
-                totaux[i] += valeurs[i]
+        cursor.execute(*invoice.join(line,
+                condition=line.invoice == invoice.id
+                ).join(currency,
+                condition=currency.id == invoice.currency
+                ).join(party,
+                condition=party.id == invoice.party
+                ).select(
+                Max(party.name), Max(party.lastname),
+                party.numero_carte, party.clef, invoice.currency,
+                Sum(Round(line.quantity.cast(type_name)
+                        * line.unit_price.cast(type_name),
+                        currency.digits)),
+                where=reduce_ids(invoice.id, [r.id for r in records])
+                & (line.type == 'line')
+                & (party.clef != Null) & (party.clef != ''),
+                group_by=[party.numero_carte, party.clef, invoice.currency],
+                order_by=[party.numero_carte, party.clef]))
+        currencies = {}
+        for row in cursor:
+            name, lastname, numero_carte, clef, currency_id, amount = row
+            if currency_id not in currencies:
+                currencies[currency_id] = Currency(currency_id)
+            currency = currencies[currency_id]
+            # SQLite uses float for SUM
+            yield (name+" "+(lastname or ''), numero_carte, clef, currency,
+                currency.round(Decimal(str(amount or 0))))
 
-        sorted_items = sorted(liste_docteurs.items(), key=lambda x: x[0])
-        dict_trie = dict(sorted_items)
-        # Ajouter le total au dictionnaire
-        liste_docteurs["TOTAL"] = totaux
-        cle, valeur = list(liste_docteurs.items())[-1]
-        dict_trie["TOTAL"] = totaux
+    @classmethod
+    def bank_transfer_file(cls, records, format='csv'):
+        "Génère les lignes du fichier de virement (csv ou largeur fixe)"
+        if format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, delimiter=';')
+            writer.writerow(['nom', 'numero_carte', 'clef', 'devise', 'montant'])
+            yield buffer.getvalue()
+        for name, numero_carte, clef, currency, amount in cls.bank_transfers(
+                records):
+            if format == 'csv':
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerow(
+                    [name, numero_carte or '', clef, currency.code, amount])
+                yield buffer.getvalue()
+            else:
+                yield '%-35.35s%-24.24s%-4.4s%-3.3s%018d\r\n' % (
+                    name, numero_carte or '', clef, currency.code,
+                    amount * 10 ** currency.digits)
 
-        return dict_trie
-    
-    def all_commission_docteur(self, records):
-        # Le modèle de sortie de la liste des docteurs : 
-        # {"JUDITH": (montant, impot, net_a_payer), "FRED": (montant, impot, net_a_payer), "MARINA": (montant, impot, net_a_payer)}
-        liste_docteurs = {}
-        for record in records:
-            docteur = record.party.name+" "+record.party.lastname
-            list_element = []
-            for line in record.lines:
-                if docteur in liste_docteurs.keys():
-                    liste_docteurs[docteur][0] = int(liste_docteurs[docteur][0] + line.unit_price)
-                    liste_docteurs[docteur][1] = int(liste_docteurs[docteur][1] + (0.11*float(line.unit_price)))
-                    liste_docteurs[docteur][2] = int(liste_docteurs[docteur][2] + line.amount)
-                    liste_docteurs[docteur][3] = self.contact2(id=record.party.id)
-                else:
-                    list_element.append(int(line.unit_price))
-                    list_element.append(int(0.11*float(line.unit_price)))
-                    list_element.append(int(line.amount))
-                    list_element.append(self.contact2(id=record.party.id))
-                    liste_docteurs[docteur] = list_element
-            
-        totaux = [0] * len(next(iter(liste_docteurs.values())))  # Crée une liste de zéros de la même longueur que les listes
+    @classmethod
+    def _sum_doctor_lines(cls, records):
+        """Somme des prix unitaires et des montants des lignes par partie:
+        {party_id: (unit_price, amount, currency)}"""
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        Currency = pool.get('currency.currency')
+        invoice = cls.__table__()
+        line = InvoiceLine.__table__()
+        currency = Currency.__table__()
+        cursor = Transaction().connection.cursor()
+        type_name = cls.total_amount._field.sql_type().base
 
-        # Calcul des totaux
-        for valeurs in liste_docteurs.values():
-            for i in range(len(valeurs)-1):
-                totaux[i] += valeurs[i]
+        sums = defaultdict(lambda: [Decimal(0), Decimal(0), None])
+        for sub_ids in grouped_slice([r.id for r in records]):
+            cursor.execute(*invoice.join(line,
+                    condition=line.invoice == invoice.id
+                    ).join(currency,
+                    condition=currency.id == invoice.currency
+                    ).select(invoice.party, invoice.currency,
+                    Sum(line.unit_price.cast(type_name)),
+                    Sum(Round(line.quantity.cast(type_name)
+                            * line.unit_price.cast(type_name),
+                            currency.digits)),
+                    where=reduce_ids(invoice.id, sub_ids)
+                    & (line.type == 'line'),
+                    group_by=[invoice.party, invoice.currency]))
+            for party_id, currency_id, unit_price, amount in cursor.fetchall():
+                # SQLite uses float for SUM
+                currency = Currency(currency_id)
+                sums[party_id][0] += round_price(Decimal(str(unit_price or 0)))
+                sums[party_id][1] += currency.round(Decimal(str(amount or 0)))
+                sums[party_id][2] = currency
+        return sums
 
-        sorted_items = sorted(liste_docteurs.items(), key=lambda x: x[0])
-        dict_trie = dict(sorted_items)
-        # Ajouter le total au dictionnaire
-        liste_docteurs["TOTAL"] = totaux
-        cle, valeur = list(liste_docteurs.items())[-1]
-        dict_trie["TOTAL"] = totaux
+    @classmethod
+    def _doctor_commissions(cls, records):
+        """{"NOM PRENOM": DoctorCommission, ..., "TOTAL": DoctorCommission}
+        trié par nom, en une requête pour les montants et une pour les
+        téléphones"""
+        pool = Pool()
+        Party = pool.get('party.party')
+        sums = cls._sum_doctor_lines(records)
+        contacts = cls.contacts_for(list(sums))
+
+        doctors = {}
+        for party in Party.browse(list(sums)):
+            doctor = party.name+" "+party.lastname
+            unit_price, amount, currency = sums[party.id]
+            previous = doctors.get(doctor)
+            if previous:
+                unit_price += previous.amount
+                amount += previous.net
+            doctors[doctor] = DoctorCommission(unit_price,
+                currency.round(unit_price * WITHHOLDING_RATE),
+                amount, contacts[party.id])
+
+        result = dict(sorted(doctors.items(), key=lambda x: x[0]))
+        result["TOTAL"] = DoctorCommission(
+            sum((d.amount for d in doctors.values()), Decimal(0)),
+            sum((d.withholding for d in doctors.values()), Decimal(0)),
+            sum((d.net for d in doctors.values()), Decimal(0)),
+            '')
+        return result
 
-        return dict_trie
+    @report_cached
+    def commission_docteur(self, records):
+        # Médecins sans clef uniquement
+        return self._doctor_commissions(
+            [r for r in records if not r.party.clef])
 
+    @report_cached
+    def all_commission_docteur(self, records):
+        return self._doctor_commissions(records)
 
+    @report_cached
     def total_medecin(self, records):
         # Exemplaire de sortie de liste 
-        # elements = ["montant" , "Impot", "net_a_payer"]
-        
-        elements = []
-        for record in records :
-
-            amount = sum(line.unit_price for line in record.lines)
-            elements.append(amount)
-            net_a_payer = sum(line.amount for line in record.lines)
-            elements.append(net_a_payer)
-            impots = amount - net_a_payer
-            elements.append(impots)
-
-        return elements
+        # elements = ["montant" , "net_a_payer", "Impot"]
+        amount = net_a_payer = Decimal(0)
+        for unit_price, net, _ in self._sum_doctor_lines(records).values():
+            amount += unit_price
+            net_a_payer += net
+        return [amount, net_a_payer, amount - net_a_payer]
 
     
     def on_change_agent(self, name):
@@ -873,6 +1540,7 @@ class Invoice(metaclass=PoolMeta):
         else:
             return montant_assurance
 
+    @report_cached
     def montant_recu(self, record):
         # Record corespond au recu
         # Format de la liste [prix1, prix2, prix3, prix4, prix5, total]
@@ -885,14 +1553,11 @@ class Invoice(metaclass=PoolMeta):
             sale_price_list = record.party.sale_price_list
 
         liste_montants = []
-        for line in record.lines:
-            unit_price = Decimal(0)
-            if sale_price_list : 
-                unit_price = sale_price_list.compute(
-                             record.party,
-                             line.product, line.product.list_price,
-                             line.quantity, line.product.default_uom)
-
+        if sale_price_list :
+            unit_prices = sale_price_list.compute_many(record.party, [
+                    (line.product, line.quantity, line.product.default_uom)
+                    for line in record.lines])
+            for line, unit_price in zip(record.lines, unit_prices):
                 liste_montants.append(float(unit_price)*line.quantity)
         
         total_recu = sum(liste_montants)
@@ -903,6 +1568,41 @@ class Invoice(metaclass=PoolMeta):
     
     @classmethod
     def search_total_amount_with_insurance(cls, name, clause):
+        """Recherche sur les montants enregistrés (index) des factures et sur
+        les lignes des factures qui n'en ont pas"""
+        if not cls._amount_cache_enabled():
+            return cls._search_total_amount_with_insurance_lines(name, clause)
+        pool = Pool()
+        Rule = pool.get('ir.rule')
+        invoice = cls.__table__()
+        type_name = cls.total_amount._field.sql_type().base
+        column = getattr(invoice, name + '_cache')
+
+        _, operator, value = clause
+        invoice_query = Rule.query_get('account.invoice')
+        Operator = fields.SQL_OPERATORS[operator]
+        if value is None:
+            expression = Operator(column, Null)
+        else:
+            # SQLite uses float for numeric
+            if backend.name == 'sqlite':
+                value = float(value)
+            expression = Operator(column.cast(type_name), value)
+
+        query = invoice.select(invoice.id,
+            where=(invoice.id.in_(invoice_query)
+                & (invoice.amount_cached == Literal(True))
+                & expression))
+        # Les factures sans montants enregistrés (brouillons, reprise pas
+        # encore faite) sont évaluées sur leurs lignes
+        return ['OR',
+            ('id', 'in', query),
+            [('amount_cached', '=', False)]
+            + cls._search_total_amount_with_insurance_lines(name, clause),
+            ]
+
+    @classmethod
+    def _search_total_amount_with_insurance_lines(cls, name, clause):
         pool = Pool()
         Rule = pool.get('ir.rule')
         Line = pool.get('account.invoice.line')
@@ -1003,6 +1703,29 @@ class Invoice(metaclass=PoolMeta):
 
     @classmethod
     def get_amount_with_insurance(cls, invoices, names):
+        result = {name: {} for name in names}
+        invoices_no_cache = []
+        for invoice in invoices:
+            if cls._amount_cache_enabled() and invoice.amount_cached:
+                for name in names:
+                    result[name][invoice.id] = getattr(
+                        invoice, name + '_cache')
+            else:
+                invoices_no_cache.append(invoice)
+        if invoices_no_cache:
+            computed = cls._compute_amount_with_insurance(
+                invoices_no_cache, names)
+            for name in names:
+                result[name].update(computed[name])
+        return result
+
+    @staticmethod
+    def _amount_cache_enabled():
+        return config.getboolean(
+            'z_health_extra', 'amount_cache', default=False)
+
+    @classmethod
+    def _compute_amount_with_insurance(cls, invoices, names):
         pool = Pool()
         InvoiceTax = pool.get('account.invoice.tax')
         Move = pool.get('account.move')
@@ -1092,22 +1815,6 @@ class Invoice(metaclass=PoolMeta):
             else :
                 montant_patient[invoice.id] = total_amount[invoice.id]
 
-            if invoice.payment_lines :
-                next_lines_moves = 1
-                montant_verse[invoice.id] = 0
-                remboursement[invoice.id] = 0
-                i = 0
-                while next_lines_moves != 0 :
-                    next_lines_moves = MoveLine.search([('id', '=', invoice.payment_lines[len(invoice.payment_lines) -1].id+i)], limit=1)
-                    if next_lines_moves and next_lines_moves[0].credit != 0 :
-                        next_lines_moves = next_lines_moves[0].credit
-                    else :
-                        montant_verse[invoice.id] = next_lines_moves = MoveLine.search([('id', '=', invoice.payment_lines[len(invoice.payment_lines) -1].id+i)], limit=1)[0].debit
-                        next_lines_moves = 0
-                    i = i+1
-                dernier_versement[invoice.id] = invoice.payment_lines[len(invoice.payment_lines) - 1].credit  
-                remboursement[invoice.id] = montant_verse[invoice.id] - dernier_versement[invoice.id]
-
         for invoice in invoices_no_move:
             untaxed_amount[invoice.id] = sum(
                 (line.amount for line in invoice.lines
@@ -1121,42 +1828,29 @@ class Invoice(metaclass=PoolMeta):
             else :
                 montant_patient[invoice.id] = total_amount[invoice.id]
 
-            if invoice.payment_lines :
-                next_lines_moves = 1
-                montant_verse[invoice.id] = 0
-                remboursement[invoice.id] = 0
-                i = 0
-                while next_lines_moves != 0 :
-                    next_lines_moves = MoveLine.search([('id', '=', invoice.payment_lines[len(invoice.payment_lines) -1].id+i)], limit=1)
-                    if next_lines_moves and next_lines_moves[0].credit != 0 :
-                        next_lines_moves = next_lines_moves[0].credit
-                    else :
-                        montant_verse[invoice.id] = next_lines_moves = MoveLine.search([('id', '=', invoice.payment_lines[len(invoice.payment_lines) -1].id+i)], limit=1)[0].debit
-                        next_lines_moves = 0
-                    i = i+1
-                dernier_versement[invoice.id] = invoice.payment_lines[len(invoice.payment_lines) - 1].credit  
-                remboursement[invoice.id] = montant_verse[invoice.id] - dernier_versement[invoice.id]
-        
-        if invoice.montant_assurance != None :
-            total_amount2[invoice.id] = total_amount[invoice.id] + invoice.montant_assurance
-            for invoice in invoices :
-                record = invoice
-                montant_f = invoice.montant_recu(record)[-1]
-                if invoice.montant_assurance :
-                    if invoice.montant_assurance > montant_f :
+
+        for invoice_id, (credit, debit) in cls._get_payment_history(
+                invoices).items():
+            dernier_versement[invoice_id] = credit
+            montant_verse[invoice_id] = debit
+            remboursement[invoice_id] = debit - credit
+
+        for invoice in invoices:
+            if invoice.montant_assurance is not None:
+                total_amount2[invoice.id] = (
+                    total_amount[invoice.id] + invoice.montant_assurance)
+                if invoice.montant_assurance:
+                    montant_f = Decimal(str(invoice.montant_recu(invoice)[-1]))
+                    if invoice.montant_assurance > montant_f:
                         total_amount2[invoice.id] = montant_f
-                    # with Transaction().new_transaction():
-                    #     invoice.montant_assurance = montant_f
-                    #     invoice.save()
-            # <record.format_nombre(record.montant_recu(record)[-1])>
-        else : 
-            total_amount2[invoice.id] = total_amount[invoice.id]
-
-        if invoice.health_service != None:
-                if invoice.health_service.insurance_plan != None:
-                    if invoice.health_service.insurance_plan.z_couverture == 100 and invoice.health_service.insurance_plan.plafond == None :
-                        total_amount2[invoice.id] = invoice.montant_assurance
+            else:
+                total_amount2[invoice.id] = total_amount[invoice.id]
 
+            if (invoice.health_service
+                    and invoice.health_service.insurance_plan):
+                plan = invoice.health_service.insurance_plan
+                if plan.z_couverture == 100 and plan.plafond is None:
+                    total_amount2[invoice.id] = invoice.montant_assurance
 
         result = {
             'untaxed_amount': untaxed_amount,
@@ -1173,11 +1867,153 @@ class Invoice(metaclass=PoolMeta):
                 del result[key]
         return result
 
+    @classmethod
+    def _get_payment_history(cls, invoices):
+        """Retourne {facture: (dernier_versement, montant_verse)}.
+
+        Le dernier versement est le crédit de la dernière ligne de paiement,
+        le montant versé est le débit de la première contrepartie de la même
+        pièce comptable.
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        cursor = Transaction().connection.cursor()
+        line = MoveLine.__table__()
+        payment = MoveLine.__table__()
+        counterpart = MoveLine.__table__()
+        cash = MoveLine.__table__()
+        type_name = MoveLine.credit.sql_type().base
+
+        last_lines = {}
+        for invoice in invoices:
+            if invoice.payment_lines:
+                last_lines[invoice.payment_lines[-1].id] = invoice.id
+
+        history = {}
+        for sub_ids in grouped_slice(last_lines):
+            sub_ids = list(sub_ids)
+            first_counterpart = payment.join(counterpart,
+                condition=(counterpart.move == payment.move)
+                & (counterpart.id >= payment.id)
+                & (counterpart.credit.cast(type_name) == 0)
+                ).select(payment.id.as_('line'),
+                Min(counterpart.id).as_('counterpart'),
+                where=reduce_ids(payment.id, sub_ids),
+                group_by=payment.id)
+            cursor.execute(*line.join(first_counterpart, 'LEFT',
+                    condition=first_counterpart.line == line.id
+                    ).join(cash, 'LEFT',
+                    condition=cash.id == first_counterpart.counterpart
+                    ).select(line.id, line.credit,
+                    Coalesce(cash.debit, 0).cast(type_name),
+                    where=reduce_ids(line.id, sub_ids)))
+            for line_id, credit, debit in cursor:
+                # SQLite uses float for CAST
+                if not isinstance(debit, Decimal):
+                    debit = Decimal(str(debit))
+                history[last_lines[line_id]] = (credit, debit)
+        return history
+
+    @classmethod
+    def _store_amount_cache(cls, invoices):
+        "Enregistre les montants assurance/patient calculés sur les factures"
+        if not cls._amount_cache_enabled() or not invoices:
+            return
+        values = cls._compute_amount_with_insurance(
+            invoices, AMOUNT_CACHE_FIELDS)
+        to_save = []
+        for invoice in invoices:
+            changed = not invoice.amount_cached
+            invoice.amount_cached = True
+            for name in AMOUNT_CACHE_FIELDS:
+                value = values[name][invoice.id]
+                if getattr(invoice, name + '_cache') != value:
+                    setattr(invoice, name + '_cache', value)
+                    changed = True
+            if changed:
+                to_save.append(invoice)
+        cls.save(to_save)
+
+    @classmethod
+    def _clear_amount_cache(cls, invoices):
+        """Oublie les montants enregistrés des factures modifiables, ils sont
+        recalculés à la lecture jusqu'à la prochaine transition"""
+        to_clear = [i for i in invoices
+            if i.amount_cached and i.state in {'draft', 'validated'}]
+        if to_clear:
+            values = {name + '_cache': None for name in AMOUNT_CACHE_FIELDS}
+            values['amount_cached'] = False
+            cls.write(to_clear, values)
+
+    @classmethod
+    def backfill_amount_cache(cls):
+        "Remplit les montants enregistrés des factures existantes"
+        if not cls._amount_cache_enabled():
+            return
+        invoices = cls.search([
+                ('state', 'in', ['posted', 'paid', 'cancelled']),
+                ('amount_cached', '=', False),
+                ], order=[('id', 'ASC')])
+        # Une tâche par paquet, validée dans sa propre transaction
+        for sub_invoices in grouped_slice(invoices):
+            cls.__queue__._store_amount_cache(list(sub_invoices))
+
+
+def _clear_invoice_amount_cache(records):
+    "Oublie les montants enregistrés des factures des lignes ou taxes"
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    if Invoice._amount_cache_enabled():
+        Invoice._clear_amount_cache(
+            list({r.invoice for r in records if r.invoice}))
+
+
+class Reconciliation(metaclass=PoolMeta):
+    __name__ = 'account.move.reconciliation'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        reconciliations = super().create(vlist)
+        # Les paiements changent les montants versés enregistrés
+        if Invoice._amount_cache_enabled():
+            Invoice.__queue__._store_amount_cache(
+                list(_invoices_to_process(reconciliations)))
+        return reconciliations
+
+    @classmethod
+    def delete(cls, reconciliations):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        if not Invoice._amount_cache_enabled():
+            super().delete(reconciliations)
+            return
+        invoices = _invoices_to_process(reconciliations)
+        super().delete(reconciliations)
+        Invoice.__queue__._store_amount_cache(list(invoices))
+
 class InvoiceLine(metaclass=PoolMeta):
     __name__ = 'account.invoice.line'
     
     agent2 = fields.Many2One('commission.agent', 'Agent de Réalisation')
 
+    @classmethod
+    def create(cls, vlist):
+        lines = super().create(vlist)
+        _clear_invoice_amount_cache(lines)
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        _clear_invoice_amount_cache(sum(args[0::2], []))
+
+    @classmethod
+    def delete(cls, lines):
+        _clear_invoice_amount_cache(lines)
+        super().delete(lines)
+
     @property
     def agent_plans_used(self):
         "List of agent, plan tuple"
@@ -1212,71 +2048,108 @@ class InvoiceLine(metaclass=PoolMeta):
         return line
     
     def montant_produit(self):
-        # Record corespond au recu
-        # Format de la liste [prix1, prix2, prix3, prix4, prix5, total]
-
-        sale_price_list = None
-
-        if hasattr(self.invoice, 'tarifaire'):
-            sale_price_list = self.invoice.tarifaire
+        return self.montants_produits([self])[0]
 
-        if  sale_price_list == None and hasattr(self.invoice.party, 'sale_price_list'):
-            sale_price_list = self.invoice.party.sale_price_list
+    @classmethod
+    def montants_produits(cls, lines):
+        "Prix tarifaire des lignes, un calcul par tarifaire et partie"
+        groups = defaultdict(list)
+        for position, line in enumerate(lines):
+            sale_price_list = None
+
+            if hasattr(line.invoice, 'tarifaire'):
+                sale_price_list = line.invoice.tarifaire
+
+            if  sale_price_list == None and hasattr(line.invoice.party, 'sale_price_list'):
+                sale_price_list = line.invoice.party.sale_price_list
+
+            if sale_price_list:
+                groups[(sale_price_list, line.invoice.party)].append(position)
+
+        unit_prices = [Decimal(0)] * len(lines)
+        for (sale_price_list, party), positions in groups.items():
+            prices = sale_price_list.compute_many(party, [
+                    (lines[p].product, lines[p].quantity,
+                        lines[p].product.default_uom) for p in positions])
+            for position, unit_price in zip(positions, prices):
+                unit_prices[position] = unit_price
+        return unit_prices
 
-        unit_price = Decimal(0)
-        if sale_price_list : 
-            unit_price = sale_price_list.compute(
-                            self.invoice.party,
-                            self.product, self.product.list_price,
-                            self.quantity, self.product.default_uom)
-        
-        return unit_price
-    
     def get_commissions(self):
+        return self.get_commissions_many([self])
+
+    @classmethod
+    def get_commissions_many(cls, lines):
+        """Commissions des lignes en une passe: les prix tarifaires et les
+        taux de change ne sont calculés qu'une fois par tarifaire et par
+        devise et date."""
         pool = Pool()
         Commission = pool.get('commission')
         Currency = pool.get('currency.currency')
         Date = pool.get('ir.date')
 
-        if self.type != 'line':
-            return []
-
         today = Date.today()
+        lines = [l for l in lines if l.type == 'line']
+        rates = {}
         commissions = []
-        for agent, plan in self.agent_plans_used:
-            if not plan:
-                continue
-            with Transaction().set_context(date=self.invoice.currency_date):
-                amount2 = float(self.montant_produit())*self.quantity
-                amount = Currency.compute(self.invoice.currency,
-                    amount2, agent.currency, round=False)
-            amount = self._get_commission_amount(Decimal(amount), plan)
-            if self.invoice.health_service:
-                if self.invoice.health_service.z_remise2:
-                    amount3 = self.amount
-                    amount = self._get_commission_amount(amount3, plan)
-            if amount:
-                amount = round_price(amount)
-            if not amount:
-                continue
+        for line, unit_price in zip(lines, cls.montants_produits(lines)):
+            invoice = line.invoice
+            for agent, plan in line.agent_plans_used:
+                if not plan:
+                    continue
+                key = (invoice.currency, agent.currency, invoice.currency_date)
+                if key not in rates:
+                    with Transaction().set_context(
+                            date=invoice.currency_date):
+                        rates[key] = Currency.compute(invoice.currency,
+                            Decimal(1), agent.currency, round=False)
+                amount = (unit_price * Decimal(str(line.quantity))
+                    * rates[key])
+                if (invoice.health_service
+                        and invoice.health_service.z_remise2):
+                    amount = line.amount
+                amount = line._get_commission_amount(amount, plan)
+                if amount:
+                    amount = round_price(amount)
+                if not amount:
+                    continue
 
-            commission = Commission()
-            commission.origin = self
-            if plan.commission_method == 'posting':
-                commission.date = self.invoice.invoice_date or today
-            elif (plan.commission_method == 'payment'
-                    and self.invoice.state == 'paid'):
-                commission.date = self.invoice.reconciled or today
-            commission.agent = agent
-            commission.product = plan.commission_product
-            commission.amount = amount
-            commissions.append(commission)
+                commission = Commission()
+                commission.origin = line
+                if plan.commission_method == 'posting':
+                    commission.date = invoice.invoice_date or today
+                elif (plan.commission_method == 'payment'
+                        and invoice.state == 'paid'):
+                    commission.date = invoice.reconciled or today
+                commission.agent = agent
+                commission.product = plan.commission_product
+                commission.amount = amount
+                commissions.append(commission)
         return commissions
 
     def _get_commission_amount(self, amount, plan, pattern=None):
         return plan.compute(amount, self.product, pattern=pattern)
 
 
+class InvoiceTax(metaclass=PoolMeta):
+    __name__ = 'account.invoice.tax'
+
+    @classmethod
+    def create(cls, vlist):
+        taxes = super().create(vlist)
+        _clear_invoice_amount_cache(taxes)
+        return taxes
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        _clear_invoice_amount_cache(sum(args[0::2], []))
+
+    @classmethod
+    def delete(cls, taxes):
+        _clear_invoice_amount_cache(taxes)
+        super().delete(taxes)
+
 class ImagingTestRequest(metaclass=PoolMeta):
     'Imaging Test Request'
     __name__ = 'gnuhealth.imaging.test.request'
@@ -1312,11 +2185,14 @@ class ImagingTestResult(metaclass=PoolMeta):
 
     @staticmethod
     def prescriptor_name(id):
+        Result = Pool().get('gnuhealth.imaging.test.result')
+        return Result.prescriptor_names([id])[id]
 
-        pool = Pool()
-        Result = pool.get('gnuhealth.imaging.test.request')
-        Results = Result.search([('request', '=', id)], limit=1)
-        return Results[0].service.requestor.name.name+" "+Results[0].service.requestor.name.lastname
+    @classmethod
+    def prescriptor_names(cls, request_numbers):
+        "Nom du prescripteur de chaque numéro de demande: {numéro: nom}"
+        return _prescriptor_names(
+            'gnuhealth.imaging.test.request', request_numbers)
 
 
 class Agent(metaclass=PoolMeta):
@@ -1325,3 +2201,371 @@ class Agent(metaclass=PoolMeta):
 
     plan2 = fields.Many2One('commission.plan', "Plan Réalisations",
         help="The plan used to calculate the commission for realisator.")
+
+
+class AgentRealisation(ModelSQL, ModelView):
+    'Commission Agent Realisation'
+    __name__ = 'commission.agent.realisation'
+
+    product = fields.Many2One('product.product', 'Produit',
+        ondelete='CASCADE', select=True,
+        states={
+            'required': ~Eval('category'),
+            }, depends=['category'])
+    category = fields.Many2One('product.category', 'Catégorie',
+        ondelete='CASCADE', select=True,
+        states={
+            'required': ~Eval('product'),
+            }, depends=['product'],
+        help="Catégorie comptable des produits")
+    agent = fields.Many2One('commission.agent', 'Agent de Réalisation',
+        required=True, ondelete='CASCADE',
+        domain=[('plan2', '!=', None)])
+
+    _get_routes_cache = Cache(
+        'commission.agent.realisation.get_routes', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('product_uniq', Unique(t, t.product),
+                'z_health_extra.msg_agent_realisation_unique'),
+            ('category_uniq', Unique(t, t.category),
+                'z_health_extra.msg_agent_realisation_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        created = not backend.TableHandler.table_exist(cls._table)
+        super().__register__(module_name)
+        if created:
+            cls._migrate_legacy_routes()
+
+    @classmethod
+    def _migrate_legacy_routes(cls):
+        pool = Pool()
+        Agent = pool.get('commission.agent')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Category = pool.get('product.category')
+        table = cls.__table__()
+        agent = Agent.__table__()
+        party = Party.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        category = Category.__table__()
+        cursor = Transaction().connection.cursor()
+
+        products, categories = set(), set()
+        for names, federation_account in _LEGACY_AGENTS_REALISATION:
+            cursor.execute(*agent.join(party,
+                    condition=agent.party == party.id
+                    ).select(Min(agent.id),
+                    where=(party.federation_account == federation_account)
+                    & (agent.plan2 != Null)))
+            agent_id, = cursor.fetchone()
+            if not agent_id:
+                continue
+            cursor.execute(*product.join(template,
+                    condition=product.template == template.id
+                    ).select(product.id,
+                    where=product.code.in_(names) | template.code.in_(names)))
+            product_ids = {p for p, in cursor} - products
+            cursor.execute(*category.select(category.id,
+                    where=category.name.in_(names)))
+            category_ids = {c for c, in cursor} - categories
+            values = ([[p, None, agent_id] for p in product_ids]
+                + [[None, c, agent_id] for c in category_ids])
+            if values:
+                cursor.execute(*table.insert(
+                        [table.product, table.category, table.agent], values))
+            products |= product_ids
+            categories |= category_ids
+
+    @classmethod
+    def get_routes(cls):
+        "Agents de réalisation par produit et par catégorie"
+        routes = cls._get_routes_cache.get(None)
+        if routes is not None:
+            return routes
+        routes = {'product': {}, 'category': {}}
+        for route in cls.search([]):
+            if route.product:
+                routes['product'][route.product.id] = route.agent.id
+            else:
+                routes['category'][route.category.id] = route.agent.id
+        cls._get_routes_cache.set(None, routes)
+        return routes
+
+    @classmethod
+    def get_agent(cls, product):
+        "Agent de réalisation du produit, celui du produit avant la catégorie"
+        routes = cls.get_routes()
+        agent_id = routes['product'].get(product.id)
+        if agent_id is None and product.account_category:
+            agent_id = routes['category'].get(product.account_category.id)
+        return agent_id
+
+    @classmethod
+    def create(cls, vlist):
+        routes = super().create(vlist)
+        cls._get_routes_cache.clear()
+        return routes
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._get_routes_cache.clear()
+
+    @classmethod
+    def delete(cls, routes):
+        super().delete(routes)
+        cls._get_routes_cache.clear()
+
+
+class SalesRollup(ModelSQL, ModelView):
+    'Sales Rollup'
+    __name__ = 'account.invoice.sales_rollup'
+
+    date = fields.Date('Date', required=True, readonly=True, select=True)
+    company = fields.Many2One('company.company', 'Société', required=True,
+        readonly=True, select=True)
+    category = fields.Many2One('product.category', 'Catégorie',
+        readonly=True, select=True,
+        help="Catégorie comptable juste sous la racine")
+    product = fields.Many2One('product.product', 'Produit', readonly=True)
+    payer_type = fields.Selection([
+            ('insured', 'Assuré'),
+            ('pdmd', 'PDMD'),
+            ('credit', 'Crédit'),
+            ], 'Payeur', required=True, readonly=True)
+    quantity = fields.Float('Quantité', readonly=True)
+    amount = fields.Numeric('Montant', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+        cls.__rpc__.update({
+                'rebuild': RPC(readonly=False),
+                'verify': RPC(),
+                })
+
+    @classmethod
+    def _get_deltas(cls, invoices):
+        """Ventes des factures client par
+        {(date, société, catégorie, produit, payeur): [quantité, montant]}"""
+        pool = Pool()
+        Category = pool.get('product.category')
+        Invoice = pool.get('account.invoice')
+
+        invoices = [i for i in invoices if i.type == 'out']
+        top_level = Category.get_top_level_map()
+        services = Invoice._get_synthesis_services(invoices)
+        deltas = defaultdict(lambda: [0., Decimal(0)])
+        for invoice in invoices:
+            if invoice.id in services:
+                payer_type = 'insured' if services[invoice.id][0] else 'pdmd'
+            else:
+                payer_type = 'credit'
+            for line in invoice.lines:
+                if line.type != 'line':
+                    continue
+                product = line.product
+                category = cls.get_category(product)
+                key = (invoice.invoice_date, invoice.company.id,
+                    top_level[category.id] if category else None,
+                    product.id if product else None, payer_type)
+                deltas[key][0] += line.quantity or 0
+                deltas[key][1] += line.amount or Decimal(0)
+        return deltas
+
+    @classmethod
+    def _create_rows(cls, deltas, sign=1):
+        cls.create([{
+                    'date': date,
+                    'company': company,
+                    'category': category,
+                    'product': product,
+                    'payer_type': payer_type,
+                    'quantity': sign * quantity,
+                    'amount': sign * amount,
+                    }
+                for (date, company, category, product, payer_type),
+                (quantity, amount) in deltas.items()
+                if quantity or amount])
+
+    @staticmethod
+    def get_category(product):
+        "Catégorie du produit utilisée pour les ventes par catégorie"
+        return product.account_category if product else None
+
+    @classmethod
+    def _net_posted(cls, invoices):
+        """Factures client comptabilisées parmi invoices et leurs factures
+        liées (facture d'origine et avoirs) filtrées par net_invoices.
+        Une facture d'origine annulée (avoir de remboursement) reste
+        rapprochée de son avoir."""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        numbers = set()
+        for invoice in invoices:
+            numbers.update(filter(None, [invoice.number, invoice.reference]))
+        related = set()
+        for sub_numbers in grouped_slice(numbers):
+            sub_numbers = list(sub_numbers)
+            related.update(Invoice.search([
+                        ('type', '=', 'out'),
+                        ('state', 'in', ['posted', 'paid', 'cancelled']),
+                        ['OR',
+                            ('number', 'in', sub_numbers),
+                            ('reference', 'in', sub_numbers),
+                            ],
+                        ]))
+        posted = {i for i in related if i.state in {'posted', 'paid'}}
+        references = {i.reference for i in posted if i.reference}
+        originals = {i for i in related
+            if i.state == 'cancelled' and i.number in references}
+        return [i for i in Invoice.net_invoices(
+                sorted(posted | originals, key=lambda i: i.id))
+            if i in posted]
+
+    @staticmethod
+    def _enabled():
+        return config.getboolean(
+            'z_health_extra', 'sales_rollup', default=True)
+
+    @staticmethod
+    def _date_domain(start_date=None, end_date=None, name='date'):
+        domain = []
+        if start_date:
+            domain.append((name, '>=', start_date))
+        if end_date:
+            domain.append((name, '<=', end_date))
+        return domain
+
+    @classmethod
+    def _compute(cls, start_date=None, end_date=None):
+        "Ventes recalculées depuis les lignes de facture"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        invoices = Invoice.search([
+                ('type', '=', 'out'),
+                ('state', 'in', ['posted', 'paid']),
+                ] + cls._date_domain(start_date, end_date, 'invoice_date'),
+            order=[('id', 'ASC')])
+        deltas = defaultdict(lambda: [0., Decimal(0)])
+        for sub_invoices in grouped_slice(invoices):
+            sub_ids = {i.id for i in sub_invoices}
+            # Les factures liées peuvent être hors de la période
+            net = [i for i in cls._net_posted(Invoice.browse(list(sub_ids)))
+                if i.id in sub_ids]
+            for key, (quantity, amount) in cls._get_deltas(net).items():
+                deltas[key][0] += quantity
+                deltas[key][1] += amount
+        return deltas
+
+    @classmethod
+    def rebuild(cls, start_date=None, end_date=None):
+        "Recalcule la période depuis les factures avec une ligne par clé"
+        cls.delete(cls.search(cls._date_domain(start_date, end_date)))
+        cls._create_rows(cls._compute(start_date, end_date))
+
+    @classmethod
+    def rebuild_recent(cls):
+        """Recalcule les derniers jours (tâche planifiée), un avoir pouvant
+        annuler une facture des jours précédents"""
+        pool = Pool()
+        Date = pool.get('ir.date')
+        if not cls._enabled():
+            return
+        days = config.getint('z_health_extra', 'sales_rollup_days', default=31)
+        cls.rebuild(Date.today() - timedelta(days=days))
+
+    @classmethod
+    def verify(cls, start_date=None, end_date=None):
+        """Compare la période aux factures et retourne les écarts
+        [(clé, (quantité, montant) enregistrés, (quantité, montant) attendus)]
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        expected = cls._compute(start_date, end_date)
+        stored = cls.get_totals(start_date, end_date)
+
+        differences = []
+        for key in sorted(set(expected) | set(stored), key=str):
+            currency = Company(key[1]).currency
+            values = []
+            for totals in [stored, expected]:
+                quantity, amount = totals.get(key, (0., Decimal(0)))
+                values.append((round(quantity, 6), currency.round(amount)))
+            if values[0] != values[1]:
+                differences.append((key, *values))
+        return differences
+
+    @classmethod
+    def get_totals(cls, start_date=None, end_date=None, company=None):
+        """Ventes enregistrées sur la période par
+        {(date, société, catégorie, produit, payeur): (quantité, montant)}"""
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        type_name = cls.amount.sql_type().base
+
+        where = Literal(True)
+        if start_date:
+            where &= table.date >= start_date
+        if end_date:
+            where &= table.date <= end_date
+        if company is not None:
+            where &= table.company == company
+        keys = [table.date, table.company, table.category, table.product,
+            table.payer_type]
+        cursor.execute(*table.select(*keys,
+                Sum(table.quantity), Sum(table.amount.cast(type_name)),
+                where=where, group_by=keys))
+        totals = {}
+        for row in cursor:
+            date_, quantity, amount = row[0], row[-2], row[-1]
+            # SQLite retourne des chaînes pour les dates et des float
+            # pour SUM
+            if isinstance(date_, str):
+                date_ = date.fromisoformat(date_)
+            if amount is not None and not isinstance(amount, Decimal):
+                amount = Decimal(str(amount))
+            totals[(date_,) + tuple(row[1:-2])] = (
+                quantity or 0., amount or Decimal(0))
+        return totals
+
+    @classmethod
+    def get_sales_by_root_category(cls, start_date=None, end_date=None,
+            company=None):
+        "Montant des ventes de la période par catégorie: [{nom: montant}]"
+        pool = Pool()
+        Category = pool.get('product.category')
+        category_totals = defaultdict(Decimal)
+        for key, (_, amount) in cls.get_totals(
+                start_date, end_date, company=company).items():
+            if key[2]:
+                category_totals[key[2]] += amount
+
+        name_totals = defaultdict(Decimal)
+        for category in Category.browse(list(category_totals)):
+            name_totals[category.name] += category_totals[category.id]
+        return [{k: v} for k, v in name_totals.items()]
+
+
+class BankTransferReport(Report):
+    'Bank Transfer'
+    __name__ = 'account.invoice.bank_transfer'
+
+    @classmethod
+    def _execute(cls, records, header, data, action):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        format_ = config.get(
+            'z_health_extra', 'bank_transfer_format', default='csv')
+        content = ''.join(Invoice.bank_transfer_file(records, format_))
+        return ('csv' if format_ == 'csv' else 'txt'), content
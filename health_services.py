@@ -21,6 +21,7 @@
 #
 ##############################################################################
 import datetime
+import logging
 from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, Equal
@@ -30,6 +31,8 @@ from trytond.modules.health.core import get_institution
 from trytond.pool import PoolMeta
 from decimal import Decimal, InvalidOperation
 
+logger = logging.getLogger(__name__)
+
 
 class HealthService(metaclass=PoolMeta):
     'Health Service'
@@ -53,3 +56,20 @@ class HealthService(metaclass=PoolMeta):
                 return Decimal(self.z_remise2)
             else :
                 return Decimal(10)
+
+    @classmethod
+    def create_invoices(cls, services, position=1, total=1):
+        "Facture un lot de services, appelé par ir.queue"
+        pool = Pool()
+        CreateServiceInvoice = pool.get(
+            'gnuhealth.service.invoice.create', type='wizard')
+        cls.lock(services)
+        # Un lot relancé ne refacture pas les services déjà facturés
+        services = [s for s in services if s.state != 'invoiced']
+        if services:
+            session_id, _, _ = CreateServiceInvoice.create()
+            CreateServiceInvoice(session_id).create_service_invoices(
+                services)
+            CreateServiceInvoice.delete(session_id)
+        logger.info("Service invoicing batch %s/%s: %s services invoiced",
+            position, total, len(services))
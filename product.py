@@ -0,0 +1,235 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from collections import defaultdict
+
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from trytond.modules.product_price_list.price_list import (
+    PriceList as BasePriceList)
+
+_MISSING = object()
+
+
+class Category(metaclass=PoolMeta):
+    __name__ = 'product.category'
+
+    _top_level_cache = Cache('product.category.top_level', context=False)
+
+    @classmethod
+    def get_top_level_map(cls):
+        """Retourne {catégorie: catégorie juste sous la racine} pour toutes
+        les catégories. Une catégorie racine est sa propre catégorie."""
+        top_level = cls._top_level_cache.get(None)
+        if top_level is not None:
+            return top_level
+        cursor = Transaction().connection.cursor()
+        category = cls.__table__()
+        cursor.execute(*category.select(category.id, category.parent))
+        parents = dict(cursor)
+        top_level = {}
+        for category_id in parents:
+            top = category_id
+            while parents.get(top) and parents.get(parents[top]):
+                top = parents[top]
+            top_level[category_id] = top
+        cls._top_level_cache.set(None, top_level)
+        return top_level
+
+    @classmethod
+    def get_top_level(cls, category):
+        if not category:
+            return category
+        return cls(cls.get_top_level_map()[category.id])
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        categories = super().create(*args, **kwargs)
+        cls._top_level_cache.clear()
+        return categories
+
+    @classmethod
+    def write(cls, *args, **kwargs):
+        super().write(*args, **kwargs)
+        cls._top_level_cache.clear()
+
+    @classmethod
+    def delete(cls, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        cls._top_level_cache.clear()
+
+
+class PriceList(metaclass=PoolMeta):
+    __name__ = 'product.price_list'
+
+    _compute_cache = Cache(
+        'product.price_list.compute', size_limit=10240, context=False)
+    _decision_table_cache = Cache(
+        'product.price_list.decision_table', context=False)
+
+    def _compute_cache_key(self, party, product, unit_price, quantity, uom):
+        """Clé du prix calculé: le prix de revient entre dans la clé car les
+        formules peuvent l'utiliser"""
+        pool = Pool()
+        Date = pool.get('ir.date')
+        return (self.id, party.id if party else None,
+            product.id if product else None, unit_price,
+            product.cost_price if product else None,
+            quantity, uom.id if uom else None, Date.today())
+
+    def get_decision_table(self):
+        """Retourne les lignes du tarifaire indexées par produit et par
+        catégorie: {'lines': [id], 'product': {id: [position]},
+        'category': {id: [position]}, 'default': [position]}"""
+        table = self._decision_table_cache.get(self.id)
+        if table is not None:
+            return table
+        table = {
+            'lines': [],
+            'product': defaultdict(list),
+            'category': defaultdict(list),
+            'default': [],
+            }
+        for position, line in enumerate(self.lines):
+            table['lines'].append(line.id)
+            if line.product:
+                table['product'][line.product.id].append(position)
+            elif line.category:
+                table['category'][line.category.id].append(position)
+            else:
+                table['default'].append(position)
+        table['product'] = dict(table['product'])
+        table['category'] = dict(table['category'])
+        self._decision_table_cache.set(self.id, table)
+        return table
+
+    def compute_many(self, party, lines):
+        """Calcule en une passe les prix de [(produit, quantité, unité)] à
+        partir du prix de vente des produits.
+        Retourne la liste des prix unitaires dans le même ordre."""
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        PriceListLine = pool.get('product.price_list.line')
+
+        def parents(categories):
+            for category in categories:
+                while category:
+                    yield category
+                    category = category.parent
+
+        # Un autre module peut changer le calcul: la table ne le suit pas
+        overridden = type(self).compute is not BasePriceList.compute
+        table = self.get_decision_table()
+        price_lines = PriceListLine.browse(table['lines'])
+        prices = {}
+        result = []
+        for product, quantity, uom in lines:
+            unit_price = product.list_price if product else None
+            key = self._compute_cache_key(
+                party, product, unit_price, quantity, uom)
+            if key not in prices:
+                prices[key] = self._compute_cache.get(key, _MISSING)
+            if prices[key] is _MISSING and overridden:
+                price = self.compute(party, product, unit_price, quantity, uom)
+                self._compute_cache.set(key, price)
+                prices[key] = price
+            if prices[key] is _MISSING:
+                pattern = {}
+                positions = set(table['default'])
+                if product:
+                    categories = [c.id for c in parents(
+                            product.categories_all)]
+                    pattern['categories'] = categories
+                    pattern['product'] = product.id
+                    positions.update(table['product'].get(product.id, []))
+                    for category in categories:
+                        positions.update(table['category'].get(category, []))
+                pattern['quantity'] = Uom.compute_qty(uom, quantity,
+                    self.get_uom(product), round=False) if product else quantity
+
+                price = unit_price
+                for position in sorted(positions):
+                    line = price_lines[position]
+                    if line.match(pattern):
+                        context = self.get_context_formula(party, product,
+                            unit_price, quantity, uom, pattern=pattern)
+                        price = line.get_unit_price(**context)
+                        break
+                self._compute_cache.set(key, price)
+                prices[key] = price
+            result.append(prices[key])
+        return result
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        price_lists = super().create(*args, **kwargs)
+        cls._compute_cache.clear()
+        return price_lists
+
+    @classmethod
+    def write(cls, *args, **kwargs):
+        super().write(*args, **kwargs)
+        cls._compute_cache.clear()
+        cls._decision_table_cache.clear()
+
+    @classmethod
+    def delete(cls, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        cls._compute_cache.clear()
+        cls._decision_table_cache.clear()
+
+
+class PriceListLine(metaclass=PoolMeta):
+    __name__ = 'product.price_list.line'
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        lines = super().create(*args, **kwargs)
+        PriceList._compute_cache.clear()
+        PriceList._decision_table_cache.clear()
+        return lines
+
+    @classmethod
+    def write(cls, *args, **kwargs):
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        super().write(*args, **kwargs)
+        PriceList._compute_cache.clear()
+        PriceList._decision_table_cache.clear()
+
+    @classmethod
+    def delete(cls, *args, **kwargs):
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        super().delete(*args, **kwargs)
+        PriceList._compute_cache.clear()
+        PriceList._decision_table_cache.clear()
+
+
+class ProductListPrice(metaclass=PoolMeta):
+    __name__ = 'product.list_price'
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        list_prices = super().create(*args, **kwargs)
+        PriceList._compute_cache.clear()
+        return list_prices
+
+    @classmethod
+    def write(cls, *args, **kwargs):
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        super().write(*args, **kwargs)
+        PriceList._compute_cache.clear()
+
+    @classmethod
+    def delete(cls, *args, **kwargs):
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        super().delete(*args, **kwargs)
+        PriceList._compute_cache.clear()
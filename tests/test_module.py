@@ -1,11 +1,321 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.tests.test_tryton import ModuleTestCase
+import operator
+from decimal import Decimal
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.company.tests import create_company, set_company
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    }
+
+
+def create_invoicing(company):
+    "Plan comptable, exercice, tiers, produit et mode de paiement"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Category = pool.get('product.category')
+    FiscalYear = pool.get('account.fiscalyear')
+    Journal = pool.get('account.journal')
+    Party = pool.get('party.party')
+    PaymentMethod = pool.get('account.invoice.payment.method')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    create_chart(company)
+    fiscalyear = set_invoice_sequences(get_fiscalyear(company))
+    fiscalyear.save()
+    FiscalYear.create_period([fiscalyear])
+
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('company', '=', company.id),
+            ])
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('company', '=', company.id),
+            ])
+    expense, = Account.search([
+            ('type.expense', '=', True),
+            ('company', '=', company.id),
+            ])
+    cash, = Account.search([
+            ('name', '=', 'Main Cash'),
+            ('company', '=', company.id),
+            ])
+    journal_revenue, = Journal.search([('type', '=', 'revenue')])
+    journal_cash, = Journal.search([('type', '=', 'cash')])
+
+    payment_method = PaymentMethod(name='Cash', journal=journal_cash,
+        credit_account=cash, debit_account=cash)
+    payment_method.save()
+    party = Party(name='Patient', addresses=[{}])
+    party.save()
+    unit, = Uom.search([('name', '=', 'Unit')])
+    category = Category(name='Actes', accounting=True,
+        account_revenue=revenue, account_expense=expense)
+    category.save()
+    template = Template(name='Consultation', type='service',
+        default_uom=unit, list_price=Decimal(40), account_category=category,
+        products=[{}])
+    template.save()
+    product, = template.products
+    return {
+        'company': company,
+        'party': party,
+        'product': product,
+        'receivable': receivable,
+        'revenue': revenue,
+        'journal': journal_revenue,
+        'payment_method': payment_method,
+        }
+
+
+def create_invoice(invoicing, quantity, unit_price, **values):
+    "Facture client d'une ligne"
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    company = invoicing['company']
+    party = invoicing['party']
+    product = invoicing['product']
+    values.update({
+            'type': 'out',
+            'company': company.id,
+            'currency': company.currency.id,
+            'party': party.id,
+            'invoice_address': party.addresses[0].id,
+            'account': invoicing['receivable'].id,
+            'journal': invoicing['journal'].id,
+            'lines': [('create', [{
+                            'type': 'line',
+                            'product': product.id,
+                            'description': product.name,
+                            'quantity': quantity,
+                            'unit': product.default_uom.id,
+                            'unit_price': unit_price,
+                            'account': invoicing['revenue'].id,
+                            }])],
+            })
+    invoice, = Invoice.create([values])
+    return invoice
+
+
+def payment_history_per_line(invoice):
+    """(dernier_versement, montant_versé) lus ligne par ligne à partir de la
+    dernière ligne de paiement, comme avant le calcul en SQL"""
+    pool = Pool()
+    MoveLine = pool.get('account.move.line')
+    last_line = invoice.payment_lines[-1]
+    i = 0
+    while True:
+        line, = MoveLine.search([('id', '=', last_line.id + i)])
+        if line.credit == 0:
+            return last_line.credit, line.debit
+        i += 1
 
 
 class ZHealthExtraTestCase(ModuleTestCase):
     "Test Z Health Extra module"
     module = 'z_health_extra'
 
+    def enable_amount_cache(self):
+        if not config.has_section('z_health_extra'):
+            config.add_section('z_health_extra')
+        config.set('z_health_extra', 'amount_cache', 'True')
+        self.addCleanup(
+            config.remove_option, 'z_health_extra', 'amount_cache')
+
+    @with_transaction()
+    def test_search_amount_with_insurance(self):
+        "Test searching insurance amounts matches the computed amounts"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+
+        self.enable_amount_cache()
+        company = create_company()
+        with set_company(company):
+            invoicing = create_invoicing(company)
+            invoices = [
+                create_invoice(invoicing, 5, Decimal(40)),
+                create_invoice(invoicing, 1, Decimal(100),
+                    montant_assurance=Decimal(50)),
+                create_invoice(invoicing, 2, Decimal(100)),
+                create_invoice(invoicing, 3, Decimal(10)),
+                create_invoice(invoicing, 1, Decimal(200)),
+                ]
+            Invoice.post(invoices[:3])
+            # Facture comptabilisée avant la reprise des montants
+            Invoice.write([invoices[2]], {
+                    'amount_cached': False,
+                    'montant_patient_cache': None,
+                    'total_amount2_cache': None,
+                    })
+            InvoiceLine.write(list(invoices[3].lines), {'quantity': 20})
+            self.assertEqual(
+                [i.amount_cached for i in Invoice.browse(invoices)],
+                [True, True, False, False, False])
+
+            names = ['montant_patient', 'total_amount2']
+            amounts = Invoice._compute_amount_with_insurance(
+                Invoice.browse(invoices), names)
+            for name in names:
+                for operator_, value in [
+                        ('=', Decimal(200)),
+                        ('<', Decimal(200)),
+                        ('>=', Decimal(200)),
+                        ('=', None),
+                        ('!=', None),
+                        ]:
+                    with self.subTest(
+                            name=name, operator=operator_, value=value):
+                        found = Invoice.search([
+                                (name, operator_, value),
+                                ('id', 'in', [i.id for i in invoices]),
+                                ])
+                        if value is None:
+                            expected = {i for i, a in amounts[name].items()
+                                if OPERATORS[operator_](a, None)}
+                        else:
+                            expected = {i for i, a in amounts[name].items()
+                                if a is not None
+                                and OPERATORS[operator_](a, value)}
+                        self.assertEqual({i.id for i in found}, expected)
+
+    @with_transaction()
+    def test_payment_history(self):
+        "Test payment history matches the per line computation"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Invoice = pool.get('account.invoice')
+
+        company = create_company()
+        with set_company(company):
+            invoicing = create_invoicing(company)
+            payment_method = invoicing['payment_method']
+            today = Date.today()
+            partial = create_invoice(invoicing, 5, Decimal(40))
+            overpaid = create_invoice(invoicing, 1, Decimal(100))
+            credit_note = create_invoice(invoicing, -1, Decimal(60))
+            unpaid = create_invoice(invoicing, 1, Decimal(10))
+            invoices = [partial, overpaid, credit_note, unpaid]
+            Invoice.post(invoices)
+
+            partial.pay_invoice(Decimal(50), payment_method, today)
+            partial.pay_invoice(Decimal(100), payment_method, today)
+            overpaid.pay_invoice(Decimal(150), payment_method, today,
+                overpayment=Decimal(50))
+            credit_note.pay_invoice(Decimal(-60), payment_method, today)
+
+            invoices = Invoice.browse(invoices)
+            history = Invoice._get_payment_history(invoices)
+            self.assertEqual(history, {
+                    i.id: payment_history_per_line(i)
+                    for i in invoices if i.payment_lines})
+            self.assertEqual(
+                history[partial.id], (Decimal(100), Decimal(100)))
+            self.assertEqual(
+                history[overpaid.id], (Decimal(100), Decimal(150)))
+            self.assertEqual(
+                history[credit_note.id], (Decimal(0), Decimal(60)))
+            self.assertNotIn(unpaid.id, history)
+
+    @with_transaction()
+    def test_sales_rollup_refund(self):
+        "Test sales rollup nets a refunded invoice with its credit note"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        SalesRollup = pool.get('account.invoice.sales_rollup')
+
+        company = create_company()
+        with set_company(company):
+            invoicing = create_invoicing(company)
+            kept = create_invoice(invoicing, 5, Decimal(40),
+                montant_assurance=Decimal(0))
+            refunded = create_invoice(invoicing, 2, Decimal(100),
+                montant_assurance=Decimal(0))
+            Invoice.post([kept, refunded])
+            credit_note, = Invoice.credit([refunded], refund=True)
+            self.assertEqual(refunded.state, 'cancelled')
+
+            SalesRollup.rebuild()
+            self.assertEqual(SalesRollup.verify(), [])
+            totals = SalesRollup.get_totals()
+            self.assertEqual(
+                sum((a for _, a in totals.values()), Decimal(0)),
+                Decimal(200))
+            self.assertEqual(
+                Invoice.get_sales_by_root_category(
+                    kept, [kept, refunded, credit_note]),
+                [{'Actes': Decimal(200)}])
+
+    @with_transaction()
+    def test_price_list_compute_many(self):
+        "Test bulk price list pricing matches compute"
+        pool = Pool()
+        Category = pool.get('product.category')
+        PriceList = pool.get('product.price_list')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            pack = Uom(name='Pack', symbol='pk', category=unit.category,
+                factor=10, rate=0.1, rounding=1, digits=0)
+            pack.save()
+            parent = Category(name='Examens')
+            parent.save()
+            child = Category(name='Biologie', parent=parent)
+            child.save()
+            products = []
+            for name, categories in [
+                    ('Consultation', []),
+                    ('Glycémie', [child]),
+                    ('Pansement', []),
+                    ]:
+                template = Template(name=name, default_uom=unit,
+                    list_price=Decimal(100), categories=categories,
+                    products=[{}])
+                template.save()
+                products.extend(template.products)
+            product = products[0]
+            price_list = PriceList(name='Tarif', lines=[
+                    {'sequence': 1, 'quantity': 100,
+                        'formula': 'unit_price * 0.5'},
+                    {'sequence': 2, 'product': product.id, 'quantity': 10,
+                        'formula': 'unit_price * 0.8'},
+                    {'sequence': 3, 'product': product.id,
+                        'formula': 'unit_price * 0.9'},
+                    {'sequence': 4, 'category': child.id, 'quantity': 5,
+                        'formula': 'unit_price * 0.7'},
+                    {'sequence': 5, 'category': parent.id,
+                        'formula': 'unit_price - 1'},
+                    {'sequence': 6, 'formula': 'unit_price + 1'},
+                    ])
+            price_list.save()
+
+            lines = [(p, q, unit)
+                for p in products for q in [1, 5, 10, 100]]
+            lines.append((product, 1, pack))
+            expected = [price_list.compute(None, p, p.list_price, q, u)
+                for p, q, u in lines]
+            # Chaque ligne du tarifaire est utilisée au moins une fois
+            self.assertEqual(len(set(expected)), 6)
+            self.assertEqual(price_list.compute_many(None, lines), expected)
+            # Seconde passe servie par le cache
+            self.assertEqual(price_list.compute_many(None, lines), expected)
+
 
 del ModuleTestCase
@@ -35,101 +35,13 @@ from trytond.transaction import Transaction
 from trytond.pool import Pool
 from decimal import Decimal
 from trytond.modules.product import round_price
+from trytond.config import config
+from trytond.tools import grouped_slice
 from ..exceptions import (
     ServiceInvoiced, NoInvoiceAddress, NoPaymentTerm, NoAccountReceivable)
 
 __all__ = ['CreateServiceInvoice']
 
-products_code = ["PEF4",
-                "PEF10",
-                "PEF6",
-                "PEF7",
-                "PEF9",
-                "PEF8",
-                "PEF18",
-                "PEF12",
-                "PEF5",
-                "PEF2",
-                "PEF11",
-                "PEF26",
-                "PEF13",
-                "PAM18",
-                "PEF16",
-                "PEF23",
-                "PEF22",
-                "PIE20",
-                "PCO15",
-                "PSY01",
-                "PSY02",
-                "PSY03",
-                "PSY04",
-                "PSY05",
-                "PLAC22",
-                "PLAC23",
-                "PLAC21",
-                "ACTES MEDICAUX TECHNIQUES"
-                ]
-
-psychiatrie = [
-                "ACE",
-                "BDI",
-                "BIG 5",
-                "CDI",
-                "DEP-ADO",
-                "DESSIN DE FAMILLE",
-                "ESP",
-                "FAT",
-                "FI",
-                "H & R",
-                "IPPA",
-                "ISP",
-                "LA",
-                "MBI",
-                "MMSE",
-                "PCL- 5",
-                "RCMAS",
-                "REY",
-                "SCL - 90",
-                "SEI",
-                "STAI Y-A et B",
-                "WLC"
-
-]
-
-infiltration = ["PAM34",
-                "PAM36",
-                "PAM61",
-                "PAM62",
-                "PAM60",
-                "PAM64",
-                "PAM65",
-                "PAM70",
-                "PAM71",
-                "PAM72",
-                "PAM47",
-                "PIE51"]
-
-anatomo = ["PLAC1",
-                "PLAC9",
-                "PLAC10",
-                "PLAC14",
-                "PLAC16",
-                "PLAC17",
-                "PLAC23",
-                "ANATOMO-CYTOPATHOLOGIE"]
-
-ophtalmologie = [
-                "PCO24",
-                "POPH4",
-                "OPHTALMOLOGIE"]
-
-kinesitherapie = ["KINESITHERAPIE",
-                  "K1",
-                  "K2",
-                  "K3",
-                  "K4",
-                  "K5",]
-
 
 
 class CreateServiceInvoice(metaclass=PoolMeta):
@@ -139,32 +51,122 @@ class CreateServiceInvoice(metaclass=PoolMeta):
 #  @param : Insurance, service line product
 #  @return : Policy applied to that service line
 
+    def _get_party_invoice_data(self, party, acct_config):
+        "Compte client, adresse et condition de paiement de la partie"
+        pool = Pool()
+        Party = pool.get('party.party')
+        invoice_data = {}
+
+        """ Look for the AR account in the following order:
+            * Party
+            * Default AR in accounting config
+            * Raise an error if there is no AR account
+        """
+        if (party.account_receivable):
+            invoice_data['account'] = party.account_receivable.id
+        elif (acct_config.default_account_receivable):
+            invoice_data['account'] = \
+                acct_config.default_account_receivable.id
+        else:
+            raise NoAccountReceivable(
+                gettext('health_insurance.msg_no_account_receivable'))
+
+        party_address = Party.address_get(party, type='invoice')
+        if not party_address:
+            raise NoInvoiceAddress(
+                gettext('health_insurance.msg_no_invoice_address')
+                )
+        invoice_data['invoice_address'] = party_address.id
+
+        """ Look for the payment term in the following order:
+            * Party
+            * Default payment term in accounting config
+            * Raise an error if there is no payment term
+        """
+        if (party.customer_payment_term):
+            invoice_data['payment_term'] = party.customer_payment_term.id
+        elif (acct_config.default_customer_payment_term):
+            invoice_data['payment_term'] = \
+                acct_config.default_customer_payment_term.id
+        else:
+            raise NoPaymentTerm(
+                gettext('health_insurance.msg_no_payment_term')
+                )
+        return invoice_data
+
+    @staticmethod
+    def _get_service_party(service):
+        "Partie facturée pour le service"
+        if service.invoice_to:
+            return service.invoice_to
+        return service.patient.name
+
     def transition_create_service_invoice(self):
+        pool = Pool()
+        HealthService = pool.get('gnuhealth.health_service')
+        AcctConfig = pool.get('account.configuration')
+
+        services = HealthService.browse(Transaction().context.get(
+            'active_ids'))
+
+        # Les gros lots sont facturés en tâche de fond par paquets si
+        # invoice_queue_size est configuré
+        size = config.getint('z_health_extra', 'invoice_queue_size',
+            default=0)
+        if size and len(services) > size:
+            acct_config = AcctConfig(1)
+            parties = set()
+            for service in services:
+                if service.state == 'invoiced':
+                    raise ServiceInvoiced(
+                        gettext('health_insurance.msg_service_invoiced')
+                        )
+                parties.add(self._get_service_party(service))
+            # Les erreurs de paramétrage des parties sont montrées dans
+            # l'assistant et non perdues dans les tâches
+            for party in parties:
+                self._get_party_invoice_data(party, acct_config)
+            total = (len(services) + size - 1) // size
+            for position, sub_services in enumerate(
+                    grouped_slice(services, size), 1):
+                HealthService.__queue__.create_invoices(
+                    list(sub_services), position, total)
+        else:
+            self.create_service_invoices(services)
+        return 'end'
+
+    def create_service_invoices(self, services):
         pool = Pool()
         HealthService = pool.get('gnuhealth.health_service')
         Invoice = pool.get('account.invoice')
-        Party = pool.get('party.party')
         Journal = pool.get('account.journal')
         AcctConfig = pool.get('account.configuration')
-        Agent_Commission = pool.get('commission.agent')
         acct_config = AcctConfig(1)
 
         currency_id = Transaction().context.get('currency')
 
-        services = HealthService.browse(Transaction().context.get(
-            'active_ids'))
         invoices = []
 
+        # Résolus une seule fois pour tous les services
+        journals = Journal.search([
+            ('type', '=', 'revenue'),
+            ], limit=1)
+
+        if journals:
+            journal, = journals
+        else:
+            journal = None
+        AgentRealisation = pool.get('commission.agent.realisation')
+        parties_data = {}
+        discounts = {}
+
         # Invoice Header
         for service in services:
             if service.state == 'invoiced':
                 raise ServiceInvoiced(
                     gettext('health_insurance.msg_service_invoiced')
                     )
-            if service.invoice_to:
-                party = service.invoice_to
-            else:
-                party = service.patient.name
+            party = self._get_service_party(service)
             invoice_data = {}
             invoice_data['description'] = service.desc
             invoice_data['party'] = party.id
@@ -175,19 +177,10 @@ class CreateServiceInvoice(metaclass=PoolMeta):
             invoice_data['tarifaire'] = service.patient.name.sale_price_list
             # print("le tarifaire service ------- ", service.patient.name.sale_price_list)
 
-            """ Look for the AR account in the following order:
-                * Party
-                * Default AR in accounting config
-                * Raise an error if there is no AR account
-            """
-            if (party.account_receivable):
-                invoice_data['account'] = party.account_receivable.id
-            elif (acct_config.default_account_receivable):
-                invoice_data['account'] = \
-                    acct_config.default_account_receivable.id
-            else:
-                raise NoAccountReceivable(
-                    gettext('health_insurance.msg_no_account_receivable'))
+            if party.id not in parties_data:
+                parties_data[party.id] = self._get_party_invoice_data(
+                    party, acct_config)
+            invoice_data.update(parties_data[party.id])
 
             ctx = {}
             sale_price_list = None
@@ -200,41 +193,9 @@ class CreateServiceInvoice(metaclass=PoolMeta):
                 ctx['currency'] = currency_id
                 ctx['customer'] = party.id
 
-            journals = Journal.search([
-                ('type', '=', 'revenue'),
-                ], limit=1)
-
-            if journals:
-                journal, = journals
-            else:
-                journal = None
-
             invoice_data['journal'] = journal.id
-
-            party_address = Party.address_get(party, type='invoice')
-            if not party_address:
-                raise NoInvoiceAddress(
-                    gettext('health_insurance.msg_no_invoice_address')
-                    )
-
-            invoice_data['invoice_address'] = party_address.id
             invoice_data['reference'] = service.name
 
-            """ Look for the payment term in the following order:
-                * Party
-                * Default payment term in accounting config
-                * Raise an error if there is no payment term
-            """
-            if (party.customer_payment_term):
-                invoice_data['payment_term'] = party.customer_payment_term.id
-            elif (acct_config.default_customer_payment_term):
-                invoice_data['payment_term'] = \
-                    acct_config.default_customer_payment_term.id
-            else:
-                raise NoPaymentTerm(
-                    gettext('health_insurance.msg_no_payment_term')
-                    )
-
             # Invoice Lines
             seq = 0
             invoice_lines = []
@@ -242,19 +203,18 @@ class CreateServiceInvoice(metaclass=PoolMeta):
             if service.insurance_plan and service.insurance_plan.plafond :
                 plafond = service.insurance_plan.plafond
             total_assurance = Decimal(0)
-            for line in service.service_line:
+            if sale_price_list:
+                with Transaction().set_context(ctx):
+                    unit_prices = sale_price_list.compute_many(party, [
+                            (line.product, line.qty, line.product.default_uom)
+                            for line in service.service_line])
+            else:
+                unit_prices = [
+                    line.product.list_price for line in service.service_line]
+            for line, unit_price in zip(service.service_line, unit_prices):
                 plafond2 = plafond
                 seq = seq + 1
                 account = line.product.template.account_revenue_used.id
-
-                if sale_price_list:
-                    with Transaction().set_context(ctx):
-                        unit_price = sale_price_list.compute(
-                            party,
-                            line.product, line.product.list_price,
-                            line.qty, line.product.default_uom)
-                else:
-                    unit_price = line.product.list_price
                 
                 unit_price2 = unit_price
 
@@ -268,9 +228,12 @@ class CreateServiceInvoice(metaclass=PoolMeta):
 
                     # Check the Insurance policy for this service
                     if service.insurance_plan:
-                        discount = self.discount_policy(
-                            service.insurance_plan,
-                            line.product)
+                        key = (service.insurance_plan.id, line.product.id)
+                        if key not in discounts:
+                            discounts[key] = self.discount_policy(
+                                service.insurance_plan,
+                                line.product)
+                        discount = discounts[key]
 
                         amount = unit_price * line.qty
 
@@ -360,25 +323,8 @@ class CreateServiceInvoice(metaclass=PoolMeta):
                             unit_price = amount/line.qty
                             unit_price = unit_price.quantize(Decimal('0.001'), rounding=ROUND_HALF_UP)
                     
-                    agent_realisation = None
-                    if line.product.code in products_code or line.product.account_category.name in products_code:
-                        agent_realisation = Agent_Commission.search([('party.federation_account', '=', "XXXKNS238KWQ"), ('plan2', '!=', None)])
-                    elif line.product.code in infiltration or line.product.account_category.name in infiltration :
-                        agent_realisation = Agent_Commission.search([('party.federation_account', '=', "XXXWWH987DMG"), ('plan2', '!=', None)])
-                    elif line.product.code in anatomo or line.product.account_category.name in anatomo :
-                        agent_realisation = Agent_Commission.search([('party.federation_account', '=', "XXXVYP466SBQ"), ('plan2', '!=', None)])
-                    elif line.product.code in ophtalmologie or line.product.account_category.name in ophtalmologie :
-                        agent_realisation = Agent_Commission.search([('party.federation_account', '=', "XXXXYP530SIH"), ('plan2', '!=', None)])
-                    elif line.product.code in kinesitherapie or line.product.account_category.name in kinesitherapie :
-                        agent_realisation = Agent_Commission.search([('party.federation_account', '=', "XXXSRS840ZWU"), ('plan2', '!=', None)])
-                    elif line.product.code in psychiatrie or line.product.account_category.name in psychiatrie :
-                        agent_realisation = Agent_Commission.search([('party.federation_account', '=', "XXXGHD415FDH"), ('plan2', '!=', None)])
-
-                    if agent_realisation :
-                        realisateur = agent_realisation[0]
-                    else :
-                        realisateur = None
-                    
+                    realisateur = AgentRealisation.get_agent(line.product)
+
                     invoice_lines.append(('create', [{
                             'origin': str(line),
                             'product': line.product.id,
@@ -407,9 +353,9 @@ class CreateServiceInvoice(metaclass=PoolMeta):
 
             invoices.append(invoice_data)
 
-        Invoice.update_taxes(Invoice.create(invoices))
+        invoices = Invoice.create(invoices)
+        Invoice.update_taxes(invoices)
 
         # Change to invoiced the status on the service document.
         HealthService.write(services, {'state': 'invoiced'})
-
-        return 'end'
\ No newline at end of file
+        return invoices